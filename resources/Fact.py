@@ -17,22 +17,146 @@ dsl.data.subhourly()) for details.
 It is generally best to treat Facts as immutable; they should be created by
 getData() and other methods of crnscript. This is not, however, enforced.
 
-One design consideration: since we sometimes have lots and lots of Facts, we
-could decrease memory overhead by implementing __slots__ in Fact. A bit of
-initial research suggests that savings is approximately 150 bytes per object
-(http://www.redmountainsw.com/wordpress/archives/python-memory-usage-using-__slots__).
-Since getData() is by default capped to 120,000 facts, that'd be a savings of
-about 18MB. Big, but not enough to warrant the change at this point. If we find
-that a) users are wanting many more Facts pretty often, or b) users are hitting
-memory limits, we can reevaluate.
+Since we sometimes have lots and lots of Facts (multi-million-fact pulls with
+allowQuerySizeOverride() are now routine), Fact uses __slots__ rather than a
+per-instance dict, for the fixed fields as well as the lazily cached ones. A
+consequence is that no other attributes can be set on a Fact. To see what a
+Fact costs, run src/factMemoryBenchmark.py, which compares bytes per Fact at a
+million Facts with a dict, with __slots__, and with __slots__ and the scaled
+integer value described below.
+
+For the same reason, a Fact's value is kept as an integer and a scale (the
+number of digits after the decimal point) rather than as a Decimal; the Decimal
+is only made (and then kept) when something asks for value. FactCollection's
+sum(), mean(), min(), max() and differences() work on the integers directly,
+giving exactly the Decimals the same arithmetic on value would.
 '''
 
 from crn import *
-from decimal import Decimal
+from decimal import Decimal, getcontext
+from itertools import izip
+import re
 from ElementSubhourlyGroupManager import ElementSubhourlyGroupManager
 from dsl.domainquery import *
+from dsl.domainquery import _datetimeFromId
+
+PLAINDECIMAL = re.compile(r"^(-?[0-9]+)(?:\.([0-9]*))?$")
+
+def _scaledFromString(string):
+    ''' Returns (unscaled,scale) for a plain decimal string such as '-12.30', the same as 
+        _scaledFromDecimal(Decimal(string)) but without making the Decimal. Returns None for anything
+        else (exponents, spaces, negative zero and so on), which is left to Decimal. '''
+    match = PLAINDECIMAL.match(string)
+    if match is None:
+        return None
+    (whole,fraction) = match.groups()
+    fraction = fraction or ""
+    unscaled = int(whole + fraction)
+    if unscaled == 0 and whole.startswith("-"):
+        return None
+    return (unscaled,len(fraction))
+
+def _scaledFromDecimal(value):
+    ''' Returns (unscaled,scale) such that value is unscaled * 10**-scale, keeping value's own exponent 
+        (so _decimalFromScaled() gives back an identical Decimal, trailing zeros and all). Returns None
+        for values which can't be held that way: negative zero, NaN and infinity. '''
+    (sign,digits,exponent) = value.as_tuple()
+    if not isinstance(exponent,int): # NaN or infinity
+        return None
+    unscaled = 0
+    for digit in digits:
+        unscaled = unscaled * 10 + digit
+    if sign:
+        if unscaled == 0: return None
+        unscaled = -unscaled
+    return (unscaled,-exponent)
+
+def _decimalFromScaled(unscaled,scale):
+    ''' The inverse of _scaledFromDecimal(). '''
+    if scale <= 0:
+        return Decimal("%dE%d" % (unscaled,-scale))
+    digits = str(abs(unscaled)).zfill(scale + 1)
+    return Decimal("%s%s.%s" % ("-" if unscaled < 0 else "",digits[:-scale],digits[-scale:]))
+
+def _exactSum(unscaleds,scales,valueAt):
+    ''' Returns just what sum() of a sequence of values would (in the Decimal context set up by crn), 
+        adding them as integers. Takes parallel sequences of the values' unscaled integers and scales (as 
+        from _scaledFromDecimal(); an unscaled of None means there's only the Decimal), and a function 
+        returning the i-th value as a Decimal. Like sum(), starts from the int 0 (and returns it if there 
+        are no values). Once the total might need rounding, the rest is added up as Decimals. '''
+    prec = getcontext().prec
+    limit = 10**prec
+    (total,totalScale,count) = (0,0,0)
+    for (unscaled,scale) in izip(unscaleds,scales):
+        if unscaled is None or abs(scale - totalScale) > prec: # Decimal would round or rescale
+            break
+        if scale > totalScale:
+            (newTotal,newScale) = (total * 10**(scale - totalScale) + unscaled,scale)
+        else:
+            (newTotal,newScale) = (total + unscaled * 10**(totalScale - scale),totalScale)
+        if abs(newTotal) >= limit:
+            break
+        (total,totalScale,count) = (newTotal,newScale,count + 1)
+    result = _decimalFromScaled(total,totalScale) if count else 0
+    for i in xrange(count,len(unscaleds)):
+        result = result + valueAt(i)
+    return result
+
+def _exactExtreme(unscaleds,scales,valueAt,largest):
+    ''' Returns the largest value (or smallest, if largest is False) of a sequence of values, as max() 
+        (or min()) would: the first of any equal values, as the Decimal valueAt() gives for it. Takes 
+        the same parameters as _exactSum(). '''
+    best = None
+    for (i,(unscaled,scale)) in enumerate(izip(unscaleds,scales)):
+        if unscaled is None:
+            values = [valueAt(j) for j in xrange(len(unscaleds))]
+            return max(values) if largest else min(values)
+        if best is None:
+            (best,bestUnscaled,bestScale) = (i,unscaled,scale)
+            continue
+        if scale == bestScale:
+            comparison = cmp(unscaled,bestUnscaled)
+        else:
+            comparison = _compareScaled(unscaled,scale,bestUnscaled,bestScale)
+        if (comparison > 0) if largest else (comparison < 0):
+            (best,bestUnscaled,bestScale) = (i,unscaled,scale)
+    if best is None:
+        raise ValueError("no values to take the %s of" % ("max" if largest else "min"))
+    return valueAt(best)
+
+def _exactDifferences(unscaleds,scales,valueAt):
+    ''' Returns a list of the differences between each value and the one before it, just as subtracting 
+        the Decimals would give. Takes the same parameters as _exactSum(). '''
+    limit = 10**getcontext().prec
+    differences = []
+    for i in xrange(1,len(unscaleds)):
+        (earlier,earlierScale,later,laterScale) = (unscaleds[i-1],scales[i-1],unscaleds[i],scales[i])
+        if not earlier or not later: # None, or a zero, which may have a sign or rescale the result
+            differences.append(valueAt(i) - valueAt(i-1))
+            continue
+        scale = max(earlierScale,laterScale)
+        difference = later * 10**(scale - laterScale) - earlier * 10**(scale - earlierScale)
+        if abs(difference) >= limit:
+            differences.append(valueAt(i) - valueAt(i-1))
+        else:
+            differences.append(_decimalFromScaled(difference,scale))
+    return differences
+
+def _compareScaled(unscaled,scale,otherUnscaled,otherScale):
+    ''' Compares two values given as (unscaled,scale), as cmp() would compare the Decimals. '''
+    return cmp(unscaled * 10**max(0,otherScale - scale),otherUnscaled * 10**max(0,scale - otherScale))
+
+def _datetimeSortKey(fact):
+    ''' Returns the key that orders Facts by datetime, as FactCollection.forLocalDay() does: by datetimeId, then
+        subhourly period (5-minute Facts share their hour's datetimeId), then station name and element name.
+        FactStore.sort(byDatetime=True) builds the same key from its columns. '''
+    return (fact.datetimeId,fact.subhourlyTime or "",fact.station.nameString,fact.element.name)
 
 class Fact(object): # subclassing object makes Fact a new-style class
+    __slots__ = ("stationId","datetimeId","elementId","flag","decimalPlaces","publishedDecimalPlaces",
+                 "_unscaled","_scale", # the value, as in _scaledFromDecimal(); _unscaled is None if only _value will do
+                 "_value","_station","_element","_datetime", # lazily cached; unset until first asked for
+                 "_subhourlyName","_subhourlyId","_subhourlyDescription","_subhourlyTime")
     
     def __init__(self,elementValue):
         if elementValue.getValue() is None:
@@ -40,12 +164,27 @@ class Fact(object): # subclassing object makes Fact a new-style class
         self.stationId      = int(elementValue.stationId)
         self.datetimeId     = int(elementValue.datetimeId)
         self.elementId      = int(elementValue.elementId)
-        self.value          = Decimal(elementValue.getValue())
+        scaled = _scaledFromString(elementValue.getValue())
+        if scaled is None:
+            self.value      = Decimal(elementValue.getValue())
+        else:
+            (self._unscaled,self._scale) = scaled
         self.flag           = int(elementValue.getFlags().intValue())
         self.decimalPlaces  = int(elementValue.getDecimalPlaces() or 0)
         self.publishedDecimalPlaces = int(elementValue.getPublishedDecimalPlaces() or 0)
-        self._esgManager     = ElementSubhourlyGroupManager.getManager()
         
+    def getValue(self):
+        try:
+            return self._value
+        except:
+            self._value = _decimalFromScaled(self._unscaled,self._scale)
+            return self._value
+    def setValue(self,value):
+        self._value = value
+        scaled = _scaledFromDecimal(value) if isinstance(value,Decimal) else None
+        (self._unscaled,self._scale) = scaled or (None,None)
+    value = property(getValue,setValue)
+    
     def getStation(self):
         try:
             return self._station
@@ -70,7 +209,7 @@ class Fact(object): # subclassing object makes Fact a new-style class
         try:
             return self._datetime
         except:
-            self._datetime = findDate(self.datetimeId)
+            self._datetime = _datetimeFromId(self.datetimeId)
             return self._datetime
     def setDatetime(self,dt):
         self._datetime = dt
@@ -81,7 +220,7 @@ class Fact(object): # subclassing object makes Fact a new-style class
         try:
             return self._subhourlyName
         except:
-            self._subhourlyName = self._esgManager.getNameFromId(self.elementId)
+            self._subhourlyName = ElementSubhourlyGroupManager.getManager().getNameFromId(self.elementId)
             return self._subhourlyName
         
     @property
@@ -89,8 +228,9 @@ class Fact(object): # subclassing object makes Fact a new-style class
         try:
             return self._subhourlyId
         except:
-            self._subhourlyTime = self._esgManager.getTime(self.elementId) # Populate this 1st, because once the id's changed it can't be done.
-            self._subhourlyId = self._esgManager.getId(self.elementId)
+            esgManager = ElementSubhourlyGroupManager.getManager()
+            self._subhourlyTime = esgManager.getTime(self.elementId) # Populate this 1st, because once the id's changed it can't be done.
+            self._subhourlyId = esgManager.getId(self.elementId)
             return self._subhourlyId
         
     @property
@@ -98,7 +238,7 @@ class Fact(object): # subclassing object makes Fact a new-style class
         try:
             return self._subhourlyDescription
         except:
-            self._subhourlyDescription = self._esgManager.getDescriptionFromId(self.elementId)
+            self._subhourlyDescription = ElementSubhourlyGroupManager.getManager().getDescriptionFromId(self.elementId)
             return self._subhourlyDescription
         
     @property
@@ -106,9 +246,19 @@ class Fact(object): # subclassing object makes Fact a new-style class
         try:
             return self._subhourlyTime
         except:
-            self._subhourlyTime = self._esgManager.getTime(self.elementId)
+            self._subhourlyTime = ElementSubhourlyGroupManager.getManager().getTime(self.elementId)
             return self._subhourlyTime
 
+    def __copy__(self):
+        ''' Supports copy.copy() (as used by subhourly()), copying whichever slots are set. '''
+        duplicate = Fact.__new__(Fact)
+        for name in Fact.__slots__:
+            try:
+                setattr(duplicate,name,getattr(self,name))
+            except AttributeError: # Lazy field not filled in yet
+                pass
+        return duplicate
+    
     def _isSubhourly(self):
         return (self.elementId >= 10000) # This range of element IDs is used for the artificial subhourly elements
             
@@ -131,8 +281,13 @@ class Fact(object): # subclassing object makes Fact a new-style class
                 return cmp(self.datetimeId,other.datetimeId)
         
         # We can now have some simpler logic for the remaining comparison fields (we couldn't earlier because of the subhourly logic)
-        return cmp((self.element.name,self.value,self.flag),
-                   (other.element.name,other.value,other.flag))
+        if self.element.name != other.element.name:
+            return cmp(self.element.name,other.element.name)
+        if self._unscaled is None or other._unscaled is None:
+            comparison = cmp(self.value,other.value)
+        else: # Compare the values without making Decimals of them
+            comparison = _compareScaled(self._unscaled,self._scale,other._unscaled,other._scale)
+        return comparison or cmp(self.flag,other.flag)
 
     def __key__(self): # Explanation of this key/hash functionality: http://stackoverflow.com/questions/2909106/python-whats-a-correct-and-good-way-to-implement-hash
         return (self.stationId,self.datetimeId,self.elementId,self.value,self.flag)
@@ -146,20 +301,9 @@ class Fact(object): # subclassing object makes Fact a new-style class
             otherwise a string representation is used.  Note that printing a Fact
             for the first time is slightly more expensive than one might expect,
             since it will probably be executing findStation, findElement, and
-            findDate.
-                    
-            __repr__ can't be dynamically overridden in any easy way (see
-            http://programming.itags.org/python/78/ ), which we sometimes want
-            to do with facts, so we defer to an arbitrary _factRepr, which *can* be
-            dynamically overridden.  
+            findDate. For the shorter form used when printing observations,
+            see _terseRepr().
         '''
-        return self._factRepr()
-    
-    def _factRepr(self):
-        ''' Fact's __repr__ defers to this method. By default it references _standardRepr()
-            but it can be reset to point to either _standardRepr() or _terseRepr() (see
-            dsl.data.groupedByObservation() for example).
-        ''' 
         return self._standardRepr()
     
     def _standardRepr(self):
@@ -171,7 +315,8 @@ class Fact(object): # subclassing object makes Fact a new-style class
             return formatString % (self.station.name, self.datetime.getDatetime0_23(), self.element.name, self.value, self.flag)
     
     def _terseRepr(self):
-        ''' Alternate representation for Facts, used by groupByObservation(). 
+        ''' Alternate representation for Facts, used when printing the FactCollections
+            made by groupedByObservation() (see FactCollection's terse argument).
         '''
         if self.decimalPlaces == 0:
             return "%s: %s (%d)" % (self.element.name, self.value, self.flag)
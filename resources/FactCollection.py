@@ -7,7 +7,10 @@ Created on Mar 1, 2011
 import dsl.domainquery
 
 from sets import Set
-from Fact import Fact
+import time
+from dsl.stats import _record
+from Fact import Fact, _exactSum, _exactExtreme, _exactDifferences, _datetimeSortKey
+from FactStore import FactStore, _canHold
 
 import gov.noaa.ncdc.crn.domain.Datetime as Datetime
 import gov.noaa.ncdc.crn.domain.ElementValue as ElementValue
@@ -21,17 +24,22 @@ missingValues = [missingValue1,missingValue2]
 class FactCollection(object):
     '''
     FactCollection is a wrapper around a list of Facts. It also contains lazily-created
-    dictionaries of Facts.
+    dictionaries of Facts. A terse FactCollection prints its Facts in the shorter form
+    used for observations (see groupedByObservation()). For very large pulls the list can
+    be a FactStore instead (see getData()'s columnar option), in which case grouping works
+    on its columns and each group is itself backed by a FactStore. Adding Facts from
+    subhourly(), which a FactStore can't hold, switches it back to a list.
     '''
     ''' TODO: Arguably if there are only a few Facts in a FactCollection, the dictionaries
         should not be created; the list should just be searched on demand. This reduces overhead
         at the cost of more complex internal logic.
     '''
 
-    def __init__(self,factlist=[]):
+    def __init__(self,factlist=[],terse=False):
 
         #factlist is the underlying list of Facts
         self.factlist = factlist
+        self.terse = terse
         
         #These dictionaries are created by the _groupByStation() etc functions when needed.
         self._dictByStation = None
@@ -118,6 +126,7 @@ class FactCollection(object):
         The keys of the mapping are specified by the given function, which can return any object.
         The key-function should take a single Fact as a parameter.
         '''
+        started = time.time()
         groups = {}
         for fact in self.factlist:
             groups.setdefault(key(fact), []).append(fact)
@@ -126,6 +135,7 @@ class FactCollection(object):
         for group, facts in groups.iteritems():
             results[group] = FactCollection(facts)
         
+        _record("grouping",started,len(self.factlist))
         return results
 
     def forStation(self,station):
@@ -235,20 +245,35 @@ class FactCollection(object):
     
     def append(self,fact):
         if isinstance(fact,Fact):
+            if isinstance(self.factlist,FactStore) and not _canHold([fact]):
+                self.factlist = list(self.factlist) # A FactStore can't hold subhourly() Facts
             self.factlist.append(fact)
         else:
             raise Exception("Only a Fact can be appended to a FactCollection")
         
     def extend(self,factCollection):
         if isinstance(factCollection,FactCollection):
+            if isinstance(self.factlist,FactStore) and not _canHold(factCollection.factlist):
+                self.factlist = list(self.factlist) # A FactStore can't hold subhourly() Facts
             self.factlist.extend(factCollection.factlist)
         else:
             raise Exception("Only a FactCollection can be used to extend another FactCollection")
     
     def __repr__(self):
-        factstrings = [str(f) for f in sorted(self.factlist)]
+        if self.terse:
+            factstrings = [f._terseRepr() for f in self._sortedFacts()]
+        else:
+            factstrings = [str(f) for f in self._sortedFacts()]
         return ", ".join(factstrings)
 
+    def _sortedFacts(self):
+        ''' Returns the Facts in sorted order. A FactStore is sorted in place and returned, so that 
+            its Facts are only created one at a time as they're iterated over. '''
+        if isinstance(self.factlist,FactStore):
+            self.factlist.sort()
+            return self.factlist
+        return sorted(self.factlist)
+
     def __len__(self):
         return len(self.factlist)
     
@@ -256,11 +281,45 @@ class FactCollection(object):
         return self.factlist[item]
     
     def __setitem__(self,key,value):
+        if isinstance(self.factlist,FactStore) and isinstance(value,Fact) and not _canHold([value]):
+            self.factlist = list(self.factlist) # A FactStore can't hold subhourly() Facts
         self.factlist[key] = value
         
     def __contains__(self,item):
         return item in self.factlist
 
+    ''' Arithmetic on the values, done on the integers the Facts keep them as (see Fact). Each gives exactly 
+        the Decimal(s) that the same arithmetic on f.value would, but much faster for a large collection. 
+        Missing values (-9999.0 etc) are included, just as they are in sum(data). '''
+
+    def sum(self):
+        ''' Returns the sum of the values; the same as sum(data). '''
+        return _exactSum(*self._scaledValues())
+
+    def mean(self):
+        ''' Returns the mean of the values, ie data.sum() / len(data). '''
+        return self.sum() / len(self)
+
+    def min(self):
+        ''' Returns the smallest value; the same as min([f.value for f in data]). '''
+        return _exactExtreme(*self._scaledValues()+(False,))
+
+    def max(self):
+        ''' Returns the largest value; the same as max([f.value for f in data]). '''
+        return _exactExtreme(*self._scaledValues()+(True,))
+
+    def differences(self):
+        ''' Returns a list of the differences between the value of each Fact and the one before it, in 
+            the FactCollection's order (eg in datetime order for data.forStation(s).forElement(e)). '''
+        return _exactDifferences(*self._scaledValues())
+
+    def _scaledValues(self):
+        ''' Returns the values as (unscaleds,scales,valueAt) for _exactSum() and the like. '''
+        if isinstance(self.factlist,FactStore):
+            return (self.factlist.values,self.factlist.scales,self.factlist.value)
+        facts = self.factlist
+        return ([f._unscaled for f in facts],[f._scale for f in facts],lambda i: facts[i].value)
+
     ''' We define some custom math functions so that FactCollections can be added and subtracted '''
     
     def __add__(self,other):
@@ -277,20 +336,25 @@ class FactCollection(object):
         ''' Given a list of Facts, returns a dict from datestring to a FactCollection of Facts for the local day
             represented by that datestring.
         '''
+        if isinstance(data,FactStore):
+            return self._groupStore(data,data.localDayStrings(),None,byDatetime=True)
+        started = time.time()
         stationdays = {}
-        for f in data:
-            utcdate = f.datetime
-            subhourlyOffset = 0 if f._isSubhourly() else -1 # Add a 1-hour offset for non-subhourly variables since they refer to the end of the observation hour 
-            localdate = dsl.domainquery.findDate(utcdate.datetimeId + f.station.getOffset() + subhourlyOffset)
-            localdatestring = str(localdate.getDatetime0_23())[0:8]
+        for (f,localdatestring) in zip(data,dsl.domainquery._localDayStrings(data)):
             stationdays.setdefault(localdatestring,[]).append(f)
+        _record("grouping",started,len(data))
+        started = time.time()
         for (day,factlist) in stationdays.items(): # Sort each list of facts and convert to a FactCollection
-            factlist.sort(key=lambda f: str(f.datetime)+" "+str(f.element.name))
+            factlist.sort(key=_datetimeSortKey)
             stationdays[day] = FactCollection(factlist)
+        _record("sorting",started,len(data))
         return stationdays
     
     def _groupByStation(self,data):
         ''' Given a list of Facts, returns a dict from Station to a list of Facts for that station. '''
+        if isinstance(data,FactStore):
+            return self._groupStore(data,data.stationIds,dsl.domainquery.findStation)
+        started = time.time()
         groupedById = {}
         for f in data:
             groupedById.setdefault(f.stationId,[]).append(f)
@@ -301,15 +365,21 @@ class FactCollection(object):
         groupedByStation = {}
         for curId in groupedById:
             groupedByStation[dsl.domainquery.findStation(curId)] = groupedById[curId]
+        _record("grouping",started,len(data))
         # Now sort and convert to FactCollection
+        started = time.time()
         for station in groupedByStation:
             factlist = groupedByStation[station]
             factlist.sort()
             groupedByStation[station] = FactCollection(factlist)
+        _record("sorting",started,len(data))
         return groupedByStation
     
     def _groupByElement(self,data):
         ''' Given a list of Facts, returns a dict from Element to a FactCollection of Facts for that station. '''
+        if isinstance(data,FactStore):
+            return self._groupStore(data,data.elementIds,dsl.domainquery.findElement)
+        started = time.time()
         groupedById = {}
         for f in data:
             groupedById.setdefault(f.elementId,[]).append(f)
@@ -320,15 +390,21 @@ class FactCollection(object):
         groupedByElement = {}
         for curId in groupedById:
             groupedByElement[dsl.domainquery.findElement(curId)] = groupedById[curId]
+        _record("grouping",started,len(data))
         # Now sort and convert to FactCollection
+        started = time.time()
         for station in groupedByElement:
             factlist = groupedByElement[station]
             factlist.sort()
             groupedByElement[station] = FactCollection(factlist)
+        _record("sorting",started,len(data))
         return groupedByElement
     
     def _groupByDatetime(self,data):
         ''' Given a list of Facts, returns a dict from Datetime to a FactCollection of Facts for that station. '''
+        if isinstance(data,FactStore):
+            return self._groupStore(data,data.datetimeIds,dsl.domainquery._datetimeFromId)
+        started = time.time()
         groupedById = {}
         for f in data:
             groupedById.setdefault(f.datetimeId,[]).append(f)
@@ -338,30 +414,48 @@ class FactCollection(object):
         # per key, ie once per datetime).
         groupedByDatetime = {}
         for curId in groupedById:
-            groupedByDatetime[dsl.domainquery.findDate(curId)] = groupedById[curId]
+            groupedByDatetime[dsl.domainquery._datetimeFromId(curId)] = groupedById[curId]
+        _record("grouping",started,len(data))
         # Now sort and convert to FactCollection
+        started = time.time()
         for station in groupedByDatetime:
             factlist = groupedByDatetime[station]
             factlist.sort()
             groupedByDatetime[station] = FactCollection(factlist)
+        _record("sorting",started,len(data))
         return groupedByDatetime
     
+    def _groupStore(self,store,keys,keyFor,byDatetime=False):
+        ''' Groups a FactStore by a column (or other sequence) of keys, one per row, without creating any
+            Facts. Returns a dict from keyFor(key) (or the key itself if keyFor is None) to a FactCollection
+            backed by a sorted FactStore (see FactStore.sort() for byDatetime). '''
+        started = time.time()
+        groups = {}
+        for (key,group) in store.groupBy(keys).items():
+            groups[key if keyFor is None else keyFor(key)] = group
+        _record("grouping",started,len(store))
+        started = time.time()
+        for (key,group) in groups.items():
+            group.sort(byDatetime)
+            groups[key] = FactCollection(group)
+        _record("sorting",started,len(store))
+        return groups
+
     def _groupByObservation(self,data,fillMissing=False):
         ''' Takes a dataset (a list of Facts) and groups it by station-datetime, ie
             consolidates into observations each of which contains (potentially)
             multiple element values. Returns a dict from a tuple (station name, date) to
-            a FactCollection of Facts (modified to print tersely); this returned map can
+            a terse FactCollection of Facts (see __init__()); this returned map can
             be passed to printlist, printfile, or csv. Pass an optional fillMissing=True to
             ensure that columns match for all observations.
         '''
+        started = time.time()
         groupedData = {}
         elementSet = Set() # Represents the set of all elements found in this data
         
         for fact in data:
             stationDate = fact.station.name,_prettyDate(fact.datetime)
             groupedData.setdefault(stationDate,[]).append(fact)
-            fact._factRepr = fact._terseRepr # We override the string representation of each Fact so that 
-            #                                  printing the results of groupByObservation() will be less verbose.
             elementSet.add(fact.element)
             
         for key in groupedData:
@@ -379,11 +473,10 @@ class FactCollection(object):
                     stationId  = ob[0].stationId  # pulls stationId and datetimeId from an 
                     datetimeId = ob[0].datetimeId # arbitrary representative Fact
                     newFact = _createMissingValueFact(stationId, datetimeId, el.elementId)
-                    newFact._factRepr = newFact._terseRepr # To match the other facts in grouped obs
                     valsToAdd.append(newFact)
                 ob.extend(valsToAdd)
             ob.sort()
-            groupedData[key] = FactCollection(ob)
+            groupedData[key] = FactCollection(ob,terse=True) # so that printing the results is less verbose
             
             if newFacts: # if we're adding new facts to fill in missing values, we have to
                 self.factlist.extend(newFacts) # invalidate any dicts we've built.
@@ -392,6 +485,7 @@ class FactCollection(object):
                 self._dictByElement = None # Maybe?
                 self._dictByDatetime = None
                 
+        _record("grouping",started,len(data))
         return groupedData
 
     @staticmethod
@@ -0,0 +1,246 @@
+'''
+FactStore holds a large number of Facts column by column, in parallel arrays of
+primitives, rather than as one Python object per Fact. A Fact takes several
+hundred bytes of heap (its value alone is a Decimal), while a row of a FactStore
+takes about 25, so a FactStore can hold ten times as many Facts in the same
+memory. Pass columnar=True to getData() to get a FactCollection backed by a
+FactStore.
+
+Facts are only created when they're asked for (by indexing or iterating), as
+views of a row; changing one doesn't change the FactStore. Grouping (eg by
+FactCollection.forStation()) and sorting work on the columns directly.
+
+Each value is kept as an integer and a scale, just as Fact keeps it, so the
+Decimal a view gives back is identical to the original, trailing zeros and all,
+and FactCollection's sum() and the like work straight from the columns.
+
+Facts from subhourly() can't be kept in the columns, since their minutes and
+renamed elements aren't in the database tables a view is rebuilt from; a
+FactCollection holding a FactStore switches to a list when they're added to it.
+'''
+
+from array import array
+from itertools import izip
+
+import dsl.domainquery
+from Fact import Fact, _scaledFromDecimal, _decimalFromScaled
+from ElementSubhourlyGroupManager import ElementSubhourlyGroupManager
+
+MAXUNSCALED = 2**63 - 1 # Largest magnitude of a value once its decimal point is removed
+
+class FactStore(object):
+    '''
+    A sequence of Facts kept as columns: stationIds, datetimeIds and elementIds (ints), values
+    (unscaled longs) and scales (bytes), flags (shorts), and decimalPlaces and
+    publishedDecimalPlaces (bytes). Supports len(), indexing, slicing, iteration, append() and
+    extend(), so it can stand in for the list of Facts inside a FactCollection.
+    '''
+
+    def __init__(self,facts=()):
+        self.stationIds  = array('i')
+        self.datetimeIds = array('i')
+        self.elementIds  = array('i')
+        self.values      = array('l')
+        self.scales      = array('b')
+        self.flags       = array('h')
+        self.decimalPlaces = array('b')
+        self.publishedDecimalPlaces = array('b')
+        self._exceptional = {} # row -> Decimal, for the odd value (negative zero) the columns can't hold
+        self.extend(facts)
+
+    def append(self,fact):
+        _checkStorable(fact)
+        (unscaled,scale,exceptional) = _columnValue(fact)
+        if exceptional is not None:
+            self._exceptional[len(self)] = exceptional
+        self.stationIds.append(fact.stationId)
+        self.datetimeIds.append(fact.datetimeId)
+        self.elementIds.append(fact.elementId)
+        self.values.append(unscaled)
+        self.scales.append(scale)
+        self.flags.append(fact.flag)
+        self.decimalPlaces.append(fact.decimalPlaces)
+        self.publishedDecimalPlaces.append(fact.publishedDecimalPlaces)
+
+    def extend(self,facts):
+        ''' Appends each of an iterable of Facts (or another FactStore's rows, column by column). '''
+        if isinstance(facts,FactStore):
+            offset = len(self)
+            for (column,other) in izip(self._columns(),facts._columns()):
+                column.extend(other)
+            for (row,value) in facts._exceptional.items():
+                self._exceptional[offset + row] = value
+        else:
+            for fact in facts:
+                self.append(fact)
+
+    def value(self,row):
+        ''' Returns the value of the given row as a Decimal. '''
+        row = self._row(row)
+        try:
+            return self._exceptional[row]
+        except KeyError:
+            return _decimalFromScaled(self.values[row],self.scales[row])
+
+    def subset(self,rows):
+        ''' Returns a new FactStore holding the given rows, in the given order. '''
+        subset = FactStore()
+        for (column,source) in izip(subset._columns(),self._columns()):
+            column.extend(array(source.typecode,[source[row] for row in rows]))
+        if self._exceptional:
+            for (i,row) in enumerate(rows):
+                if row in self._exceptional:
+                    subset._exceptional[i] = self._exceptional[row]
+        return subset
+
+    def groupBy(self,keys):
+        ''' Takes a sequence with a key for each row and returns a dict from each key to a FactStore
+            of its rows (in their current order). '''
+        rowsByKey = {}
+        for (row,key) in enumerate(keys):
+            rowsByKey.setdefault(key,[]).append(row)
+        groups = {}
+        for (key,rows) in rowsByKey.items():
+            groups[key] = self.subset(rows)
+        return groups
+
+    def sort(self,byDatetime=False):
+        ''' Sorts the rows in place into the same order as sorting the Facts would (by station name,
+            datetime, element name, value and flag), or with byDatetime=True into the order of
+            Fact._datetimeSortKey() (datetime, subhourly period, station name, element name). '''
+        rows = xrange(len(self))
+        stationNames = _namesById(self.stationIds,lambda s: dsl.domainquery.findStation(s).nameString)
+        elementNames = _namesById(self.elementIds,lambda e: dsl.domainquery.findElement(e).name)
+        if byDatetime:
+            periods = _namesById(self.elementIds,lambda e: ElementSubhourlyGroupManager.getManager().getTime(e) or "")
+            order = sorted(rows,key=lambda row: (self.datetimeIds[row],periods[self.elementIds[row]],
+                                                 stationNames[self.stationIds[row]],elementNames[self.elementIds[row]]))
+        else:
+            values = self._comparableValues()
+            order = sorted(rows,key=lambda row: (stationNames[self.stationIds[row]],self.datetimeIds[row],
+                                                 elementNames[self.elementIds[row]],values[row],self.flags[row]))
+        ordered = self.subset(order)
+        (self.stationIds,self.datetimeIds,self.elementIds,self.values,self.scales,self.flags,
+         self.decimalPlaces,self.publishedDecimalPlaces) = ordered._columns()
+        self._exceptional = ordered._exceptional
+
+    def localDayStrings(self):
+        ''' Returns the local day of each row as 'YYYYMMDD' (see FactCollection.forLocalDay()). '''
+        return dsl.domainquery._localDayStringsFromColumns(self.stationIds,self.datetimeIds,self.elementIds)
+
+    def __len__(self):
+        return len(self.stationIds)
+
+    def __getitem__(self,item):
+        if isinstance(item,slice):
+            return self.subset(range(*item.indices(len(self))))
+        return self._fact(item)
+
+    def __setitem__(self,row,fact):
+        if isinstance(row,slice):
+            raise TypeError("FactStore doesn't support slice assignment")
+        row = self._row(row)
+        _checkStorable(fact)
+        (unscaled,scale,exceptional) = _columnValue(fact)
+        self._exceptional.pop(row,None)
+        if exceptional is not None:
+            self._exceptional[row] = exceptional
+        self.stationIds[row]  = fact.stationId
+        self.datetimeIds[row] = fact.datetimeId
+        self.elementIds[row]  = fact.elementId
+        self.values[row] = unscaled
+        self.scales[row] = scale
+        self.flags[row]  = fact.flag
+        self.decimalPlaces[row] = fact.decimalPlaces
+        self.publishedDecimalPlaces[row] = fact.publishedDecimalPlaces
+
+    def __iter__(self):
+        for row in xrange(len(self)):
+            yield self._fact(row)
+
+    def __add__(self,other):
+        if not _canHold(other):
+            return list(self) + list(other)
+        combined = FactStore(self)
+        combined.extend(other)
+        return combined
+    def __radd__(self,other):
+        if not _canHold(other):
+            return list(other) + list(self)
+        combined = FactStore(other)
+        combined.extend(self)
+        return combined
+
+    def __repr__(self):
+        return "<FactStore of %d Facts>" % len(self)
+
+    def _fact(self,row):
+        ''' Returns a Fact for the given row. '''
+        row = self._row(row)
+        fact = Fact.__new__(Fact)
+        fact.stationId  = self.stationIds[row]
+        fact.datetimeId = self.datetimeIds[row]
+        fact.elementId  = self.elementIds[row]
+        if row in self._exceptional:
+            fact.value = self._exceptional[row]
+        else:
+            (fact._unscaled,fact._scale) = (self.values[row],self.scales[row])
+        fact.flag  = self.flags[row]
+        fact.decimalPlaces = self.decimalPlaces[row]
+        fact.publishedDecimalPlaces = self.publishedDecimalPlaces[row]
+        return fact
+
+    def _row(self,row):
+        ''' Turns a (possibly negative) index into a row number, raising IndexError if it's out of range. '''
+        if row < 0:
+            row += len(self)
+        if row < 0 or row >= len(self):
+            raise IndexError("FactStore index out of range")
+        return row
+
+    def _columns(self):
+        return (self.stationIds,self.datetimeIds,self.elementIds,self.values,self.scales,self.flags,
+                self.decimalPlaces,self.publishedDecimalPlaces)
+
+    def _comparableValues(self):
+        ''' Returns each row's value as an integer at the largest scale in the store, so that comparing
+            them compares the values. '''
+        if not len(self): return []
+        maxScale = max(self.scales)
+        return [unscaled * 10**(maxScale - scale) for (unscaled,scale) in izip(self.values,self.scales)]
+
+def _columnValue(fact):
+    ''' Returns (unscaled,scale,exceptional) for storing a Fact's value in a FactStore's columns; exceptional
+        is the value itself if the columns can't reproduce it (ie negative zero), otherwise None. '''
+    if fact._unscaled is not None:
+        scaled = (fact._unscaled,fact._scale)
+    else:
+        value = fact.value
+        scaled = _scaledFromDecimal(value)
+    if scaled is None:
+        (sign,digits,exponent) = value.as_tuple()
+        if not isinstance(exponent,int) or [digit for digit in digits if digit]:
+            raise ValueError("A FactStore can't hold the value "+str(value))
+        return (0,max(-128,min(-exponent,127)),value) # negative zero
+    (unscaled,scale) = scaled
+    if abs(unscaled) > MAXUNSCALED or not -128 <= scale <= 127:
+        raise ValueError("A FactStore can't hold the value "+str(fact.value))
+    return (unscaled,scale,None)
+
+def _checkStorable(fact):
+    ''' Raises ValueError for a Fact from subhourly(), which a FactStore can't hold (see above). '''
+    if fact._isSubhourly():
+        raise ValueError("A FactStore can't hold subhourly() Facts; keep them in a list")
+
+def _canHold(facts):
+    ''' Returns whether a FactStore can hold all of the given Facts (or FactStore, or FactCollection). '''
+    if isinstance(facts,FactStore):
+        return True
+    return not [fact for fact in facts if fact._isSubhourly()]
+
+def _namesById(ids,name):
+    ''' Returns a dict from each distinct id to its name, calling name() once per id. '''
+    names = {}
+    for i in set(ids):
+        names[i] = name(i)
+    return names
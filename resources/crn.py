@@ -48,9 +48,12 @@ from operator import attrgetter
 print "Importing utilities;", # Order is important on these to avoid circular import
 # TODO -- continue thinking about refactoring in order to not have to worry about import order.
 from dsl.utils import *
+from dsl.stats import *
 from dsl.domainquery import *
 from FactCollection import FactCollection
+from dsl.cache import *
 from dsl.data import *
+from dsl.aggregates import *
 from dsl.graph import *
 from dsl.observation import *
 from dsl.output import *
@@ -6,14 +6,17 @@ Created on May 11, 2011
 import doctest
 import unittest
 
-import data, domainquery, graph, observation, output, utils
+import aggregates, cache, data, domainquery, graph, observation, output, stats, utils
 
 suite = unittest.TestSuite()
+suite.addTest(doctest.DocTestSuite(aggregates))
+suite.addTest(doctest.DocTestSuite(cache))
 suite.addTest(doctest.DocTestSuite(data))
 suite.addTest(doctest.DocTestSuite(domainquery))
 suite.addTest(doctest.DocTestSuite(graph))
 suite.addTest(doctest.DocTestSuite(observation))
 suite.addTest(doctest.DocTestSuite(output))
+suite.addTest(doctest.DocTestSuite(stats))
 suite.addTest(doctest.DocTestSuite(utils))
 
 runner = unittest.TextTestRunner(verbosity=2)
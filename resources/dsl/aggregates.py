@@ -0,0 +1,173 @@
+'''
+Functions which summarize data inside the database (eg the daily maximum temperature for each
+station, or how many hours of data each station has), so that only the summaries, rather than
+every hourly Fact, are brought back to crnscript.
+
+Periods follow the same conventions as FactCollection.forLocalDay(): CRN datetimes refer to the
+*end* of the observation hour, so each hour is assigned to the period containing its start, in the
+station's local standard time for the local periods.
+'''
+
+from crn import *
+from dsl.domainquery import _parseDatetimeRanges
+from dsl.utils import _executeQuery
+from decimal import Decimal
+
+# Maps each period to the Oracle date format which names it and whether it's in local standard time
+AGGREGATEPERIODS = {"localDay":("YYYYMMDD",True), "localMonth":("YYYYMM",True),
+                    "utcDay":("YYYYMMDD",False), "utcMonth":("YYYYMM",False)}
+AGGREGATEFUNCTIONS = ("min","max","sum","count")
+MISSINGTEST = "to_number(f.value) in (%s)" % ",".join([str(v) for v in missingValues])
+
+class Aggregate(object):
+    ''' A summary of the non-missing values of one element at one station over one period. period is
+        a 'YYYYMMDD' or 'YYYYMM' string (or None for the whole requested range); min, max, and sum are
+        Decimals, count is the number of non-missing values, and missing is the number of missing values
+        (any that weren't asked for are None). Like Fact, has lazy-evaluated station and element properties. '''
+    __slots__ = ("stationId","elementId","period","min","max","sum","count","missing","_station","_element")
+
+    def __init__(self,stationId,elementId,period):
+        self.stationId = stationId
+        self.elementId = elementId
+        self.period    = period
+        self.min = self.max = self.sum = self.count = self.missing = None
+
+    def getStation(self):
+        try:
+            return self._station
+        except AttributeError:
+            self._station = findStation(self.stationId)
+            return self._station
+    station = property(getStation)
+
+    def getElement(self):
+        try:
+            return self._element
+        except AttributeError:
+            self._element = findElement(self.elementId)
+            return self._element
+    element = property(getElement)
+
+    def __cmp__(self,other):
+        ''' Sorts by station name, then period, then element name (to match Fact). '''
+        if type(other) is not Aggregate: return -1
+        return cmp((self.station.nameString,self.period,self.element.name),
+                   (other.station.nameString,other.period,other.element.name))
+
+    def __repr__(self):
+        values = ["%s=%s" % (fn,getattr(self,fn)) for fn in AGGREGATEFUNCTIONS+("missing",) if getattr(self,fn) is not None]
+        if self.period is None:
+            return "%s, %s: %s" % (self.station.name, self.element.name, " ".join(values))
+        return "%s, %s, %s: %s" % (self.station.name, self.period, self.element.name, " ".join(values))
+
+def getAggregates(stations,datetimes,elements,by="localDay",fns=AGGREGATEFUNCTIONS):
+    ''' Summarizes data in the database rather than retrieving every Fact, returning a list of Aggregates
+        (one per station, element, and period). Takes stations, datetimes, and elements just like getData(),
+        plus by (one of "localDay", "localMonth", "utcDay", or "utcMonth", or None to summarize the whole
+        range) and fns (any of "min", "max", "sum", and "count"). Missing values are left out of every
+        summary. For example, daily max and min
+        temperatures for every Oklahoma station for a year:
+            aggs = getAggregates("OK",("2010010101","2011010100"),("tmax","tmin"),fns=("max","min"))
+        Since the periods are assigned in the database, make sure the datetimes cover whole local days
+        (or months) if you want complete summaries. As with getData(), datetimes can be a list of ranges;
+        with by=None, they're all summarized together. Far fewer rows are brought back than with getData(),
+        so this isn't subject to getData()'s size limit.
+    '''
+    if isinstance(fns,str): fns = (fns,)
+    for fn in fns:
+        if fn not in AGGREGATEFUNCTIONS:
+            raise ValueError("Unknown aggregate function '"+str(fn)+"'; use any of "+", ".join(AGGREGATEFUNCTIONS))
+    selects = ["count(f.value)" if fn == "count" else "%s(to_number(f.value))" % fn for fn in fns]
+    return _summarize(stations,datetimes,elements,by,selects,fns,"not "+MISSINGTEST)
+
+def getCounts(stations,datetimes,elements,by=None):
+    ''' Counts values in the database without retrieving them, returning a list of Aggregates with count
+        (the number of non-missing values) and missing (the number of missing values) set, one per station
+        and element, or per station, element and period if by is given (see getAggregates()). Hours with
+        no value at all in the database aren't counted either way. No Facts are created, so availability
+        reports for the whole network are quick; eg for the percent of October hours with temperatures:
+            for c in getCounts("OK",("2011100101","2011110100"),"temp"):
+                print c.station.name, 100.0 * c.count / (31*24)
+    '''
+    selects = ["sum(case when %s then 0 else 1 end)" % MISSINGTEST, "sum(case when %s then 1 else 0 end)" % MISSINGTEST]
+    return _summarize(stations,datetimes,elements,by,selects,("count","missing"))
+
+def _summarize(stations,datetimes,elements,by,selects,fields,condition=None):
+    ''' Runs a query grouping the facts for the given stations, datetimes and elements by station, element
+        and (if by is given) period, selecting the given SQL expressions into the given Aggregate fields
+        and optionally restricting the facts with an additional SQL condition. Returns a list of Aggregates. '''
+    if by is not None and by not in AGGREGATEPERIODS:
+        raise ValueError("by must be None or one of "+", ".join(sorted(AGGREGATEPERIODS.keys())))
+
+    freshenGlobals()
+    stationIds = [s.stationId for s in findStations(stations)]
+    ranges = _parseDatetimeRanges(datetimes)
+    elementIds = [e.elementId for e in findElements(elements)]
+    if not stationIds or not elementIds: return []
+
+    period = _periodExpression(by)
+    query = ("select f.station_id, f.element_id, %s as period, %s"
+             "  from crn_fact_flag f, crn_observation o, crn_station_data s, crn_datetime d"
+             " where f.station_id=o.station_id and f.datetime_id=o.datetime_id"
+             "   and f.station_id=s.station_id and f.datetime_id=d.datetime_id"
+             "   and (%s)"
+             "   and f.station_id in (%s) and f.element_id in (%s)") % (
+             period, ", ".join(selects), " or ".join(["f.datetime_id between ? and ?"] * len(ranges)),
+             _placeholders(stationIds), _placeholders(elementIds))
+    if condition:
+        query += " and " + condition
+    query += " group by f.station_id, f.element_id"
+    if by is not None:
+        query += ", " + period
+
+    aggregates = []
+    rangeParams = [datetimeId for (begin,end) in ranges for datetimeId in (begin,end)]
+    for row in _executeQuery(query,rangeParams+stationIds+elementIds):
+        aggregate = Aggregate(int(row[0]),int(row[1]),row[2])
+        for (field,value) in zip(fields,row[3:]):
+            if value is None: continue
+            setattr(aggregate,field,int(value) if field in ("count","missing") else Decimal(value))
+        aggregates.append(aggregate)
+    return aggregates
+
+def _periodExpression(by):
+    ''' Returns the SQL expression naming the period (eg '20101010' for localDay) each fact falls in. '''
+    if by is None: return "null"
+    (dateFormat,local) = AGGREGATEPERIODS[by]
+    offset = "to_number(s.offset)-1" if local else "-1" # the -1 moves each hour to the period of its start
+    return "to_char(d.time+(%s)/24,'%s')" % (offset,dateFormat)
+
+def _placeholders(values):
+    ''' Returns a string of comma-separated '?'s, one for each value, for building an IN list. '''
+    return ",".join(["?"] * len(values))
+
+def __doctests():
+    ''' These doctests are automatically run if you run the module. You should get no output
+        unless there's a problem.
+
+    getAggregates() summarizes by local day just as FactCollection.forLocalDay() groups:
+    >>> aggs = sorted(getAggregates("stillwater 5",("10/10/10 1:00","+35"),"temp"))
+    >>> [(a.period,a.count) for a in aggs]
+    [('20101009', 6), ('20101010', 24), ('20101011', 6)]
+    >>> d = getData("stillwater 5",("10/10/10 1:00","+35"),"temp")
+    >>> [a.max == max([f.value for f in d.forLocalDay(a.period)]) for a in aggs]
+    [True, True, True]
+    >>> [a.sum == sum(d.forLocalDay(a.period)) for a in aggs]
+    [True, True, True]
+    >>> aggs = getAggregates("stillwater 5",("10/10/10 1:00","+35"),"temp",by="utcDay",fns="count")
+    >>> [(a.period,a.count,a.max) for a in sorted(aggs)]
+    [('20101010', 24, None), ('20101011', 12, None)]
+    >>> [(c.count + c.missing) for c in getCounts("stillwater 5",[(87793,87793),(87796,"+1")],"temp")]
+    [3]
+
+    getCounts() counts missing and non-missing values without creating Facts:
+    >>> [(c.count,c.missing,c.period) for c in getCounts("barrow",('10/10/10 8:00','+3'),"temp")]
+    [(4, 0, None)]
+    >>> c = getCounts("stillwater 5",("10/10/10 1:00","+35"),"temp",by="localDay")
+    >>> [c.count + c.missing for c in sorted(c)]
+    [6, 24, 6]
+    '''
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
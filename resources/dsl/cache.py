@@ -0,0 +1,483 @@
+'''
+Functions for caching Facts locally, so that repeated requests for the same data don't have to go
+back to the database. There are two layers, both consulted automatically by getData().
+
+The session cache keeps recently retrieved Facts in memory, keyed by station and element, along
+with the datetime ranges it holds for each. When a request overlaps data already in the session
+cache, only the missing stretches are requested, and the results are stitched together. It's
+limited to a budget of sessionCacheSize Facts (see setSessionCacheSize()), discarding the least
+recently used station-elements first, and anything it holds is dropped after half an hour so 
+that newly loaded data are seen. Hours after the end of a station's period of record aren't held 
+(they may not have been loaded yet), so they're requested again each time. Results bigger than a 
+quarter of the budget aren't kept, and iterData() and columnar getData() bypass the session cache
+altogether, since the point of both is to hold only a bounded amount of data at once.
+
+The fact cache keeps a copy of the data for each station, element, and (UTC) month on disk, in a
+"factcache" directory under crnscript-data. getData() consults it automatically: blocks which are
+already cached are read from disk, and only the rest are requested from the database. A cached
+block is thrown away as soon as any observation in it was loaded (or reloaded) after the block was
+cached, so re-running an analysis only goes to the database for new or reprocessed hours. The load
+times are checked with one query per month for all the stations involved, straight against
+crn_observation and crn_ob_loadlog rather than through observationDao, whose iBATIS cache could hide
+fresh loads. Only whole months are written to the cache; a request for part of a month is
+answered from the cache if that month is already there, and otherwise passed straight through to
+the database.
+'''
+
+from crn import *
+from dsl.utils import _userDataDirectory, _createEmptyDirectory
+
+import os, threading, time
+import cPickle as pickle
+from bisect import bisect_left, bisect_right
+from copy import copy
+import gov.noaa.ncdc.crn.domain.ElementValue as ElementValue
+from java.sql import Timestamp
+from dsl.utils import _executeQuery
+from dsl.domainquery import _cachedPors
+
+FACTCACHEVERSION = 1 # Bump whenever the format of the cache files changes; older files are then ignored
+CLOCKSKEW = 3600000  # Allowance (in ms) for any difference between our clock and the database's
+MAXINLIST = 1000     # Oracle's limit on the number of items in an IN list
+
+SESSIONCACHEMAXAGE = 1800 # Seconds before anything in the session cache is considered stale (matches freshenGlobals())
+SESSIONCACHEMAXSHARE = 4  # Results of more than 1/SESSIONCACHEMAXSHARE of sessionCacheSize Facts aren't kept
+
+sessionCacheSize = 500000 # Maximum number of Facts held in the session cache
+factCacheEnabled = True
+_factCacheLock = threading.RLock() # Guards reading-modifying-writing cache files from several threads
+
+def setSessionCacheSize(maxFacts):
+    ''' Sets the maximum number of Facts held in memory by the session cache (500,000 by default). When
+        the cache is over budget, the least recently used station-elements are discarded first. Pass 0 to
+        turn the session cache off entirely. '''
+    global sessionCacheSize
+    sessionCacheSize = int(maxFacts)
+    _sessionCache.evict()
+
+def clearSessionCache():
+    ''' Empties the in-memory session cache. '''
+    _sessionCache.clear()
+
+def enableFactCache():
+    ''' Turns the local fact cache back on after a call to disableFactCache(). The cache is on by default. '''
+    global factCacheEnabled
+    factCacheEnabled = True
+
+def disableFactCache():
+    ''' Turns off the local fact cache, so that getData() always goes to the database (and caches nothing). '''
+    global factCacheEnabled
+    factCacheEnabled = False
+
+def clearFactCache():
+    ''' Deletes everything in the local fact cache (in crnscript-data/factcache). Safe to call at any time;
+        the cache is simply rebuilt as data are requested. '''
+    _factCacheLock.acquire()
+    try:
+        _createEmptyDirectory(_factCacheDirectory())
+    finally:
+        _factCacheLock.release()
+
+def _fetchThroughCaches(stationIds,begin,end,elementIds,query,sessionCache=True):
+    ''' Returns a list of Facts for the given station ids, datetime ids, and element ids, going first to
+        the session cache (unless sessionCache is False), then to the fact cache, and finally calling 
+        query(stationIds,begin,end,elementIds) for whatever's left. '''
+    def queryThroughDiskCache(stationIds,begin,end,elementIds):
+        return _fetchThroughDiskCache(stationIds,begin,end,elementIds,query)
+    if not sessionCache:
+        return queryThroughDiskCache(stationIds,begin,end,elementIds)
+    return _sessionCache.fetch(stationIds,begin,end,elementIds,queryThroughDiskCache)
+
+class _SessionCacheEntry(object):
+    ''' The session cache's data for one station-element: the (begin,end) datetime ranges it holds, and 
+        the Facts within those ranges, keyed by datetime id. '''
+    def __init__(self):
+        self.created = time.time()
+        self.lastUsed = 0
+        self.ranges = []      # sorted, non-overlapping, non-adjacent (begin,end) pairs
+        self.facts = {}       # datetimeId -> Fact
+        self.datetimeIds = [] # sorted keys of self.facts, for finding the Facts in a range quickly
+
+    def factsBetween(self,begin,end):
+        lo = bisect_left(self.datetimeIds,begin)
+        hi = bisect_right(self.datetimeIds,end)
+        return [self.facts[d] for d in self.datetimeIds[lo:hi]]
+
+    def add(self,begin,end,facts):
+        for fact in facts:
+            self.facts[fact.datetimeId] = fact
+        self.datetimeIds = sorted(self.facts.keys())
+        self.ranges = _mergeRanges(self.ranges + [(begin,end)])
+
+class _SessionCache(object):
+    ''' In-memory cache of Facts keyed by (stationId,elementId). See the module documentation. '''
+    def __init__(self):
+        self.entries = {} # (stationId,elementId) -> _SessionCacheEntry
+        self.size = 0     # total number of Facts held
+        self.clock = 0    # incremented on each use, for least-recently-used eviction
+        self.lock = threading.RLock()
+
+    def fetch(self,stationIds,begin,end,elementIds,query):
+        if sessionCacheSize <= 0:
+            return query(stationIds,begin,end,elementIds)
+
+        facts = []
+        toFetch = {} # (begin,end) -> stationId -> elementIds missing that range
+        self.lock.acquire()
+        try:
+            self.clock += 1
+            now = time.time()
+            for stationId in stationIds:
+                for elementId in elementIds:
+                    key = (stationId,elementId)
+                    entry = self.entries.get(key)
+                    if entry is not None and now - entry.created > SESSIONCACHEMAXAGE:
+                        self._remove(key)
+                        entry = None
+                    if entry is None:
+                        missing = [(begin,end)]
+                    else:
+                        entry.lastUsed = self.clock
+                        facts.extend([copy(f) for f in entry.factsBetween(begin,end)])
+                        missing = _subtractRanges((begin,end),entry.ranges)
+                    for missingRange in missing:
+                        toFetch.setdefault(missingRange,{}).setdefault(stationId,[]).append(elementId)
+        finally:
+            self.lock.release()
+
+        for ((missingBegin,missingEnd),elementsByStation) in toFetch.items():
+            # Stations missing the same elements over the same range can share a single query
+            stationsByElements = {}
+            for (stationId,missingElements) in elementsByStation.items():
+                stationsByElements.setdefault(tuple(missingElements),[]).append(stationId)
+            for (missingElements,missingStations) in stationsByElements.items():
+                fetched = query(missingStations,missingBegin,missingEnd,list(missingElements))
+                facts.extend(fetched)
+                self._store(missingStations,missingBegin,missingEnd,missingElements,fetched)
+        self.evict()
+        return facts
+
+    def _store(self,stationIds,begin,end,elementIds,facts):
+        if len(facts) * SESSIONCACHEMAXSHARE > sessionCacheSize:
+            return # Would push out most of what's cached (and copying it would double its memory)
+        # Only the hours up to each station's POR end count as held; later ones may still be loaded
+        heldEnds = {}
+        for (stationId,por) in _cachedPors(stationIds).items():
+            if por is not None and por.getEndDatetime() >= begin:
+                heldEnds[stationId] = min(end,por.getEndDatetime())
+        byKey = {}
+        for stationId in heldEnds:
+            for elementId in elementIds:
+                byKey[(stationId,elementId)] = []
+        for fact in facts:
+            if fact.stationId in heldEnds and fact.datetimeId <= heldEnds[fact.stationId]:
+                byKey[(fact.stationId,fact.elementId)].append(copy(fact)) # Copies, so users can't alter what's cached
+        self.lock.acquire()
+        try:
+            for (key,keyFacts) in byKey.items():
+                entry = self.entries.get(key)
+                if entry is None:
+                    entry = self.entries[key] = _SessionCacheEntry()
+                self.size -= len(entry.facts)
+                entry.add(begin,heldEnds[key[0]],keyFacts)
+                entry.lastUsed = self.clock
+                self.size += len(entry.facts)
+        finally:
+            self.lock.release()
+
+    def evict(self):
+        ''' Discards least recently used entries until the cache is within its budget. '''
+        self.lock.acquire()
+        try:
+            if self.size <= sessionCacheSize: return
+            for (lastUsed,key) in sorted([(e.lastUsed,k) for (k,e) in self.entries.items()]):
+                self._remove(key)
+                if self.size <= sessionCacheSize: break
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.entries = {}
+            self.size = 0
+        finally:
+            self.lock.release()
+
+    def _remove(self,key):
+        self.size -= len(self.entries[key].facts)
+        del self.entries[key]
+
+_sessionCache = _SessionCache()
+
+def _mergeRanges(ranges):
+    ''' Takes a list of (begin,end) datetime id pairs and returns an equivalent sorted list in which 
+        overlapping and adjacent ranges have been merged. '''
+    merged = []
+    for (begin,end) in sorted(ranges):
+        if merged and begin <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0],max(end,merged[-1][1]))
+        else:
+            merged.append((begin,end))
+    return merged
+
+def _subtractRanges(wanted,held):
+    ''' Returns the list of (begin,end) pairs within the wanted (begin,end) pair which aren't covered by 
+        the sorted list of held pairs. '''
+    (begin,end) = wanted
+    missing = []
+    for (heldBegin,heldEnd) in held:
+        if heldEnd < begin: continue
+        if heldBegin > end: break
+        if heldBegin > begin:
+            missing.append((begin,heldBegin-1))
+        begin = heldEnd + 1
+        if begin > end: break
+    if begin <= end:
+        missing.append((begin,end))
+    return missing
+
+def _fetchThroughDiskCache(stationIds,begin,end,elementIds,query):
+    ''' Returns a list of Facts for the given station ids, datetime ids, and element ids, reading whatever
+        it can from the fact cache and calling query(stationIds,begin,end,elementIds) for the rest. Whole
+        months retrieved from the database are written back to the cache. '''
+    if not factCacheEnabled:
+        return query(stationIds,begin,end,elementIds)
+
+    facts = []
+    toFetch = {} # (yyyymm or None,begin,end,elementIds) -> stationIds still needed from the DB
+    for (yyyymm,blockBegin,blockEnd) in _monthBlocks(begin,end):
+        lo = begin if blockBegin is None else max(begin,blockBegin)
+        hi = end   if blockEnd   is None else min(end,blockEnd)
+        wholeBlock = (lo == blockBegin and hi == blockEnd)
+        if blockBegin is not None and blockEnd is not None:
+            cachedBlocks = {}
+            for stationId in stationIds:
+                cachedBlocks[stationId] = _readBlock(stationId,yyyymm)
+            # Only ask the DB about stations with something cached, and only once for all of them
+            cachedStations = [stationId for stationId in stationIds
+                              if [elementId for elementId in elementIds if elementId in cachedBlocks[stationId]]]
+            latestLoads = _latestLoadTimes(cachedStations,blockBegin,blockEnd) if cachedStations else {}
+        for stationId in stationIds:
+            missing = []
+            if blockBegin is not None and blockEnd is not None:
+                cached = cachedBlocks[stationId]
+                for elementId in elementIds:
+                    if elementId not in cached:
+                        missing.append(elementId)
+                        continue
+                    (cachedAt,rows) = cached[elementId]
+                    if cachedAt < latestLoads.get(stationId,0): # Something's been loaded since we cached this; it's stale
+                        missing.append(elementId)
+                        continue
+                    facts.extend([_factFromRow(stationId,elementId,row) for row in rows if lo <= row[0] <= hi])
+            else:
+                missing = list(elementIds)
+            if missing:
+                key = (wholeBlock and yyyymm or None, lo, hi, tuple(missing))
+                toFetch.setdefault(key,[]).append(stationId)
+
+    # Requests for the same range and elements are combined across stations to save round trips.
+    for ((yyyymm,queryBegin,queryEnd,missing),queryStations) in toFetch.items():
+        fetchTime = long(time.time() * 1000) - CLOCKSKEW # Taken *before* the query, so nothing loaded during it is missed
+        fetched = query(queryStations,queryBegin,queryEnd,list(missing))
+        facts.extend(fetched)
+        if yyyymm is not None:
+            _writeBlocks(yyyymm,queryStations,missing,fetched,fetchTime)
+    return facts
+
+def _latestLoadTimes(stationIds,blockBegin,blockEnd):
+    ''' Returns a dict from station id to the most recent load or modification time (in ms, as _loadTime() 
+        gives) of any of its observations between blockBegin and blockEnd. Load times live in crn_ob_loadlog,
+        joined in as observationDao's Observation.xml does. Stations with no observations there are left 
+        out. Makes one query per MAXINLIST stations. '''
+    latest = {}
+    for i in range(0,len(stationIds),MAXINLIST):
+        someIds = list(stationIds[i:i+MAXINLIST])
+        query = ("select ob.station_id,"
+                 "       to_char(max(greatest(nvl(ob.last_modified,oblog.time_loaded),nvl(oblog.time_loaded,ob.last_modified))),"
+                 "               'YYYY-MM-DD HH24:MI:SS')"
+                 "  from crn_observation ob, crn_ob_loadlog oblog"
+                 " where ob.station_id = oblog.station_id and ob.datetime_id = oblog.datetime_id"
+                 "   and ob.datetime_id between ? and ? and ob.station_id in (%s)"
+                 " group by ob.station_id") % ",".join(["?"] * len(someIds))
+        for (stationId,stamp) in _executeQuery(query,[blockBegin,blockEnd]+someIds):
+            if stamp is not None: # Timestamp reads it in the JVM's time zone, as JDBC does for the DAO's Dates
+                latest[int(stationId)] = Timestamp.valueOf(stamp).getTime()
+    return latest
+
+def _loadTime(observation):
+    ''' Returns the time (in ms) an observation was loaded or last modified, whichever is later, or 0 if neither
+        is recorded. '''
+    latest = 0
+    for stamp in (observation.getLastModified(),observation.getTimeLoaded()):
+        if stamp is not None and stamp.getTime() > latest:
+            latest = stamp.getTime()
+    return latest
+
+def _monthBlocks(begin,end):
+    ''' Splits the datetime ids from begin to end by UTC month, returning a list of (yyyymm,blockBegin,blockEnd)
+        tuples, where blockBegin and blockEnd are the first and last datetime ids of the *whole* month. Either
+        may be None if the month runs off the edge of the datetime table. '''
+    blocks = []
+    yyyymm = str(findDate(begin).getDatetime0_23())[0:6]
+    blockBegin = _monthStart(yyyymm)
+    while True:
+        nextMonth = _nextMonth(yyyymm)
+        nextBegin = _monthStart(nextMonth)
+        blockEnd = None if nextBegin is None else nextBegin - 1
+        blocks.append((yyyymm,blockBegin,blockEnd))
+        if blockEnd is None or blockEnd >= end: break
+        (yyyymm,blockBegin) = (nextMonth,nextBegin)
+    return blocks
+
+def _monthStart(yyyymm):
+    ''' Returns the datetime id of the first hour (00:00 on the 1st) of a yyyymm month, or None if it's not
+        in the datetime table. '''
+    try:
+        return findDate(yyyymm+"0100").datetimeId
+    except: # Off the edge of the datetime table
+        return None
+
+def _nextMonth(yyyymm):
+    ''' Returns the yyyymm string for the month after yyyymm. '''
+    (year,month) = (int(yyyymm[0:4]),int(yyyymm[4:6]))
+    if month == 12:
+        return "%04d01" % (year+1)
+    return "%04d%02d" % (year,month+1)
+
+def _factCacheDirectory():
+    ''' Returns the root directory of the fact cache, creating it if necessary. '''
+    path = os.path.join(_userDataDirectory(),"factcache")
+    if not os.path.exists(path): os.makedirs(path)
+    return path
+
+def _blockFilename(stationId,yyyymm):
+    return os.path.join(_factCacheDirectory(),str(stationId),yyyymm+".cache")
+
+def _readBlock(stationId,yyyymm):
+    ''' Returns the cached data for one station-month, as a dict from element id to a (cachedAt,rows) tuple.
+        Returns an empty dict if nothing usable is cached. '''
+    filename = _blockFilename(stationId,yyyymm)
+    if not os.path.exists(filename): return {}
+    _factCacheLock.acquire()
+    try:
+        try:
+            file = open(filename,"rb")
+            try:
+                (version,elements) = pickle.load(file)
+            finally:
+                file.close()
+        except: # A damaged file is no worse than a missing one; it'll be rewritten
+            return {}
+    finally:
+        _factCacheLock.release()
+    if version != FACTCACHEVERSION: return {}
+    return elements
+
+def _writeBlocks(yyyymm,stationIds,elementIds,facts,cachedAt):
+    ''' Writes the Facts for each station-element of one month to the cache. Station-elements with no Facts
+        are cached too (as empty), so that we know not to ask for them again. '''
+    rowsByStation = {}
+    for stationId in stationIds:
+        rowsByStation[stationId] = dict([(elementId,[]) for elementId in elementIds])
+    for fact in facts:
+        rowsByStation[fact.stationId][fact.elementId].append(_rowFromFact(fact))
+
+    _factCacheLock.acquire()
+    try:
+        for (stationId,rowsByElement) in rowsByStation.items():
+            elements = _readBlock(stationId,yyyymm)
+            for (elementId,rows) in rowsByElement.items():
+                rows.sort()
+                elements[elementId] = (cachedAt,rows)
+            _writeAtomically(_blockFilename(stationId,yyyymm),(FACTCACHEVERSION,elements))
+    finally:
+        _factCacheLock.release()
+
+def _writeAtomically(filename,contents):
+    ''' Pickles contents to a temporary file and then moves it into place, so that another crnscript process
+        reading the cache never sees a half-written file. '''
+    directory = os.path.dirname(filename)
+    if not os.path.exists(directory): os.makedirs(directory)
+    tempname = filename + ".tmp"
+    file = open(tempname,"wb")
+    try:
+        pickle.dump(contents,file,pickle.HIGHEST_PROTOCOL)
+    finally:
+        file.close()
+    if os.path.exists(filename): os.remove(filename) # rename won't overwrite on Windows
+    os.rename(tempname,filename)
+
+def _rowFromFact(fact):
+    return (fact.datetimeId,str(fact.value),fact.flag,fact.decimalPlaces,fact.publishedDecimalPlaces)
+
+def _factFromRow(stationId,elementId,row):
+    (datetimeId,value,flag,decimalPlaces,publishedDecimalPlaces) = row
+    return Fact(ElementValue(stationId,datetimeId,elementId,value,flag,decimalPlaces,publishedDecimalPlaces))
+
+def __doctests():
+    ''' These doctests are automatically run if you run the module. You should get no output
+        unless there's a problem.
+
+    A whole month's data comes from the database the first time and from the fact cache after that:
+    >>> clearFactCache()
+    >>> d1 = getData("barrow",("2009010100","2009013123"),"temp")
+    >>> os.path.exists(_blockFilename(1007,"200901"))
+    True
+    >>> clearSessionCache()
+    >>> d2 = getData("barrow",("2009010100","2009013123"),"temp")
+    >>> sorted(d1.factlist) == sorted(d2.factlist)
+    True
+
+    Part of a cached month is read from the cache too:
+    >>> printlist(getData("barrow","2009010100","temp"))
+    AK Barrow 4 ENE, 2009010100, T_OFFICIAL: -22 (0)
+
+    Overlapping requests are stitched together from the session cache:
+    >>> clearSessionCache()
+    >>> d = getData("barrow",("2009010100","+2"),"temp")
+    >>> len(getData("barrow",("2009010101","+2"),"temp"))
+    3
+    >>> _sessionCache.entries[(1007,343)].ranges
+    [(72255, 72258)]
+
+    Hours past the end of the POR aren't held, so they're requested again (and seen once they're loaded):
+    >>> clearSessionCache()
+    >>> end = getPor("barrow").getEndDatetime()
+    >>> d = getData("barrow",(end-1,end+2),"temp")
+    >>> _sessionCache.entries[(1007,343)].ranges == [(end-1,end)]
+    True
+
+    iterData() and columnar getData() bypass the session cache, and results too big for it aren't kept:
+    >>> clearSessionCache()
+    >>> chunks = list(iterData("barrow",("2009010100","+2"),"temp"))
+    >>> c = getData("barrow",("2009010100","+2"),"temp",columnar=True)
+    >>> _sessionCache.entries
+    {}
+    >>> setSessionCacheSize(8)
+    >>> d = getData("barrow",("2009010100","+2"),"temp")
+    >>> _sessionCache.entries
+    {}
+    >>> setSessionCacheSize(500000)
+
+    The load times are checked in one query, and agree with what observationDao reports:
+    >>> latest = _latestLoadTimes([1007],72255,72255+743)
+    >>> obs = observationDao.getObservations(72255,72255+743,1007).values()
+    >>> latest[1007] == max([_loadTime(ob) for ob in obs])
+    True
+
+    >>> _mergeRanges([(5,8),(1,2),(3,4),(10,12),(11,11)])
+    [(1, 8), (10, 12)]
+    >>> _subtractRanges((1,20),[(0,3),(8,9),(15,25)])
+    [(4, 7), (10, 14)]
+
+    >>> _nextMonth("200912")
+    '201001'
+    >>> [(yyyymm,blockEnd-blockBegin+1) for (yyyymm,blockBegin,blockEnd) in _monthBlocks(72255,72255+800)]
+    [('200901', 744), ('200902', 672)]
+    '''
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
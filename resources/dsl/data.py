@@ -15,13 +15,24 @@ import java.util.HashMap as HashMap
 import java.util.ArrayList as List
 import socket
 import sys
-from dsl.domainquery import _parseDatetimeParam
+import time
+from dsl.domainquery import _parseDatetimeParam, _parseDatetimeRanges, _cachedPors, NOWSTATIONID, _subhourlyDatetime, _stringFromDatetimeId
+from dsl.cache import _fetchThroughCaches, _loadTime
+from dsl.stats import _instrumented, _record, ELEMENTVALUEBYTES, FACTBYTES
+from FactStore import FactStore
 
 import gov.noaa.ncdc.crn.domain.ElementValue as ElementValue
+from java.lang import Thread
+from java.util.concurrent import Callable, ExecutionException, Executors, ThreadFactory, TimeUnit
+from bisect import bisect_left, bisect_right
 
 MAXQUERYSIZE = 120000 # Maximum number of facts which can be retrieved at once (unless overridden)
+MAXTHREADS = 8 # Maximum number of simultaneous queries for getDataParallel() (also capped by the connection pool)
+PORENDSLACK = 24*30 # Stations whose POR ends within this many hours of "now" are treated as still reporting
+BATCHWASTE = 4 # getDataMany() only merges requests if the merged query asks for at most this many times as many facts
 
-def getData(stations,datetimes,elements):
+@_instrumented("getData",FACTBYTES)
+def getData(stations,datetimes,elements,parallel=False,columnar=False):
     '''Get facts (as a Collection of Fact domain objects). Pass a station or list of stations (as Station, string or int), a 
         datetime (as Datetime, string, or int) or a tuple containing a beginDatetime and endDatetime (as Datetime, 
         string, or int), and an element or list of elements (as Element, string or int), and get back a list of Facts. 
@@ -29,40 +40,237 @@ def getData(stations,datetimes,elements):
         any way that happens to be convenient at the time. One handy additional form for dates is to use "+n" for 
         the endDatetime, with n the number of hours' data you'd like, eg ("2009010100","+24")
         
+        For several separate stretches of time, pass a list of ranges, eg the summer of each year:
+            getData("OK",[("2009060100","2009083123"),("2010060100","2010083123")],"precip")
+        Overlapping ranges are merged, and the ranges are packed into as few queries as possible. Lists of ranges 
+        work the same way with getDataParallel(), getDataAsync(), getDataSince(), getDataMany(), iterData(), 
+        getAggregates() and getCounts(); iterWindows(), getObservations() and dateRange() take a single range.
+        A DateRange with a step is taken as a list of single hours, so only every nth hour is retrieved.
+        
         Limited to getting 120,000 pieces of data at once. If you're SURE that you need more, and you're aware of the
         impact on the database, and you can't break it into several separate queries, call the allowQuerySizeOverride()
-        method before each large query. 
+        method before each large query. Only hours within each station's period of record count toward the limit (and
+        only those hours are requested), so eg getAllStations() over a long range is much cheaper than it looks.
         
         The returned Facts have the following properties: station, datetime, element, value, flag, stationId, datetimeId,
         and elementId. The ids are sometimes useful as arguments to DAO methods. 
+        
+        Pass parallel=True to split the request up and run the pieces simultaneously (see getDataParallel()).
+        
+        Pass columnar=True for very large pulls (with allowQuerySizeOverride()): the Facts are then kept in a 
+        FactStore, a tenth or so of the memory, and only created one at a time as you use them. forStation(), 
+        localDays and the like, and printing, all work as usual. Changing a Fact you get back from a columnar
+        FactCollection doesn't change the FactCollection.
     '''
-    global querySizeOverrideAllowed
+    requests = _planRequests(stations,datetimes,elements)
+    if columnar:
+        return FactCollection(_fetchColumnar(requests))
+    if parallel:
+        return FactCollection(_fetchFactsParallel(requests))
+    return FactCollection(_fetchAll(requests))
+
+def getDataParallel(stations,datetimes,elements):
+    '''Same as getData(), but splits the request up by station (or, for a single station, by time block) and 
+        runs the pieces simultaneously, each on its own connection from the database connection pool. The 
+        results are merged into a single FactCollection. Much faster than calling getData() for one station
+        at a time in a loop; for example, rather than
+            for station in getAllStations(): d = getData(station,dates,"temp") ...
+        use
+            d = getDataParallel(getAllStations(),dates,"temp")
+        and then d.forStation() to work with each station's data. Subject to the same query size limit 
+        as getData().
+    '''
+    return getData(stations,datetimes,elements,parallel=True)
+
+def getDataAsync(stations,datetimes,elements):
+    '''Same as getData(), but returns immediately, retrieving the data on a background thread. Returns a handle
+        whose get() method waits for the data (if necessary) and returns the FactCollection; it also has isDone()
+        and cancel(). Lets a script fetch the next block of data while it works on the current one, eg
+            pending = getDataAsync(stations,blocks[0],"precip")
+            for i in range(len(blocks)):
+                d = pending.get()
+                if i+1 < len(blocks): pending = getDataAsync(stations,blocks[i+1],"precip")
+                ... work with d ...
+        The parameters are checked (and the query size limit enforced) right away, so mistakes show up at the 
+        call rather than at get().
+    '''
+    requests = _planRequests(stations,datetimes,elements)
+    return _DataFuture(_asyncExecutor().submit(_GetDataTask(requests)))
+
+def iterData(stations,datetimes,elements,chunkSize=MAXQUERYSIZE,byFact=False):
+    '''Like getData(), but for pulls which are too big to hold all at once (eg several years of
+        data for the whole network). Takes the same stations, datetimes and elements as getData(),
+        breaks the request into chunks of no more than chunkSize facts each (splitting by time 
+        block first, then by station, then by element), and yields a FactCollection for each 
+        chunk in datetime order. Only one chunk is held in memory at a time. Pass byFact=True 
+        to get the individual Facts rather than a FactCollection per chunk. Since no single 
+        query is larger than chunkSize, there's no need to call allowQuerySizeOverride(). 
+        Typically used like:
+            for chunk in iterData("AK",("2008010101","2011010100"),"temp"):
+                printfile("aktemps.txt",chunk,append=True)
+    '''
+    if chunkSize < 1 or chunkSize > MAXQUERYSIZE:
+        raise ValueError("chunkSize must be between 1 and "+str(MAXQUERYSIZE))
     freshenGlobals()
     
     stations = [s.stationId for s in findStations(stations)]
-    (begin,end) = _parseDatetimeParam(datetimes)
+    elementIds = [s.elementId for s in findElements(elements)]
+    
+    chunks = []
+    for (begin,end) in _parseDatetimeRanges(datetimes):
+        for ((rangeBegin,rangeEnd),ids) in _groupByRange(_clipToPor(stations,begin,end)).items():
+            chunks.extend(_planChunks(ids,rangeBegin,rangeEnd,elementIds,chunkSize))
+    chunks.sort(key=lambda chunk: (chunk[1],chunk[0])) # datetime order
+    
+    for (chunkStations,chunkBegin,chunkEnd,chunkElements) in chunks:
+        factList = _fetchFacts(chunkStations,chunkBegin,chunkEnd,chunkElements,sessionCache=False)
+        if not factList: continue # Nothing to yield for this chunk
+        if byFact:
+            for fact in factList:
+                yield fact
+        else:
+            yield FactCollection(factList)
 
-    # Ensure query is not too big
-    if (querySizeOverrideAllowed):
-        querySizeOverrideAllowed = False
+def iterWindows(stations,datetimes,elements,window=24,overlap=0,prefetch=1):
+    '''Walks the requested range in windows of the given number of hours, each starting (window - overlap)
+        hours after the last, and yields a FactCollection for each window. Meanwhile the next prefetch windows
+        are retrieved in the background, and the hours a window shares with the one before it are reused 
+        rather than retrieved again. Takes stations, datetimes and elements just like getData(). So rather than
+            for start in range(begin,end,2): d = getData(stations,(start,start+1),elements) ...
+        use
+            for d in iterWindows(stations,(begin,end),elements,window=2): ...
+        and the database is kept busy while you work. Each window is subject to getData()'s size limit, counting
+        only the hours within each station's period of record; calling allowQuerySizeOverride() first lifts it for
+        every window. Unlike getData(), takes a single range rather than a list of ranges.
+    '''
+    global querySizeOverrideAllowed
+    if window < 1:
+        raise ValueError("window must be at least 1 hour")
+    if overlap < 0 or overlap >= window:
+        raise ValueError("overlap must be at least 0 and less than window")
+    if prefetch < 0:
+        raise ValueError("prefetch can't be negative")
+    freshenGlobals()
+    
+    stationIds = [s.stationId for s in findStations(stations)]
+    (begin,end) = _parseDatetimeParam(datetimes)
+    elementIds = [e.elementId for e in findElements(elements)]
+    
+    windows = _planWindows(begin,end,window,overlap)
+    if querySizeOverrideAllowed:
+        querySizeOverrideAllowed = False # One override covers every window
     else:
-        if _queryTooLarge(stations,begin,end,elements):
-            raise Exception("Query size too large. Aborting. ("+str(_length(stations))+" stations, "+
-                            str(end+1-begin)+" datetimes, "+str(_length(elements))+" elements).")
+        for (windowBegin,windowEnd,newBegin) in windows:
+            _checkQuerySize([_clipToPor(stationIds,windowBegin,windowEnd)],elementIds)
+    pending = [] # Handles for the not-yet-seen part of upcoming windows, in order
+    nextToFetch = 0
+    previous = []
+    try:
+        for (windowBegin,windowEnd,newBegin) in windows:
+            while nextToFetch < len(windows) and len(pending) <= prefetch:
+                (fetchBegin,fetchEnd,fetchNewBegin) = windows[nextToFetch]
+                pending.append(_fetchAsync(stationIds,fetchNewBegin,fetchEnd,elementIds))
+                nextToFetch += 1
+            current = [fact for fact in previous if fact.datetimeId >= windowBegin] + pending.pop(0).get().factlist
+            yield FactCollection(current)
+            previous = current
+    finally: # Don't leave queries running if the caller stops early
+        for handle in pending:
+            handle.cancel()
 
-    # Create a map of parameters in the form that ElementDao wants
-    elementIds = [s.elementId for s in findElements(elements)]
-    params = HashMap()
-    params["stationIds"] = stations
-    params["begin"] = begin
-    params["end"]   = end
-    params["elementIds"] = elementIds
+def getDataSince(stations,datetimes,elements,watermark=None):
+    '''For products which are rebuilt on a schedule. Takes stations, datetimes and elements just like getData(), 
+        plus a watermark, and returns a (FactCollection,newWatermark) pair. The FactCollection holds only the facts
+        whose observations were loaded or reloaded after the watermark, and newWatermark is the latest load time 
+        seen, to be passed to the next call. Watermarks are in milliseconds since 1970 (like java's Date.getTime());
+        pass None to get everything. Typically used like:
+            (d,watermark) = getDataSince(stations,dates,elements,watermarkFromLastRun)
+            for day in d.localDays: ... rebuild just that day's product ...
+            ... save watermark for the next run ...
+        Always goes to the database for the facts (bypassing the fact caches), since the point is to see what's 
+        changed. Subject to getData()'s size limit.
+    '''
+    newWatermark = watermark
+    changed = Set() # (stationId,datetimeId) of each observation loaded since the watermark
+    requests = []
+    for (stationIds,begin,end,elementIds) in _planRequests(stations,datetimes,elements):
+        for stationId in stationIds:
+            datetimeIds = []
+            for ob in observationDao.getObservations(begin,end,stationId).values():
+                loaded = _loadTime(ob)
+                if watermark is None or loaded > watermark:
+                    datetimeIds.append(int(ob.getDatetimeId()))
+                if newWatermark is None or loaded > newWatermark:
+                    newWatermark = loaded
+            for datetimeId in datetimeIds:
+                changed.add((stationId,datetimeId))
+            requests.extend([([stationId],runBegin,runEnd,elementIds) for (runBegin,runEnd) in _runs(datetimeIds)])
+    
+    # Runs of changed observations are merged into as few queries as possible (as in getDataMany()), and
+    # anything the merged queries pick up which hasn't changed is dropped.
+    # The merged queries can overlap, so each fact is kept only the first time it turns up.
+    factList = []
+    seen = Set()
+    for batch in _planBatches(requests):
+        for fact in _queryFacts(*batch):
+            key = (fact.stationId,fact.elementId,fact.datetimeId)
+            if (fact.stationId,fact.datetimeId) in changed and key not in seen:
+                seen.add(key)
+                factList.append(fact)
+    return (FactCollection(factList),newWatermark)
+
+def getDataMany(requests):
+    '''Takes a list of (stations,datetimes,elements) requests, each just like the parameters to getData(), and
+        returns a list of FactCollections, one per request and in the same order. Rather than making one query 
+        per request, the requests are merged into as few queries as possible and the results split back up, so 
+        loops which call getData() once per station-hour, eg
+            for f in soilFacts: d = getData(f.station,f.datetime,vols) ...
+        can instead do
+            for (f,d) in zip(soilFacts,getDataMany([(f.station,f.datetime,vols) for f in soilFacts])): ...
+        and make a handful of round trips to the database rather than thousands. Each request is subject to the 
+        same query size limit as getData().
+    '''
+    global querySizeOverrideAllowed
+    freshenGlobals()
+    
+    parsed = []
+    allRequests = [] # (stationIds,begin,end,elementIds) for each range of each request
+    for (stations,datetimes,elements) in requests:
+        stationIds = [s.stationId for s in findStations(stations)]
+        ranges = _parseDatetimeRanges(datetimes)
+        elementIds = [e.elementId for e in findElements(elements)]
+        hours = sum([end+1 - begin for (begin,end) in ranges])
+        if len(stationIds) * hours * len(elementIds) > MAXQUERYSIZE and not querySizeOverrideAllowed:
+            raise Exception("Query size too large. Aborting. ("+str(len(stationIds))+" stations, "+
+                            str(hours)+" hours, "+str(len(elementIds))+" elements in one request).")
+        parsed.append((stationIds,ranges,elementIds))
+        allRequests.extend([(stationIds,begin,end,elementIds) for (begin,end) in ranges])
+    querySizeOverrideAllowed = False
     
-    # Done handling input parameters. Go ahead and make the query.
-    queryResults = elementDao.getElementValues(params)
+    # Index everything retrieved by station and element, in datetime order, so each request can pick out its facts.
+    # The batches can overlap (eg requests for temp and for temp and precip make separate batches), so each 
+    # station-element's facts are keyed by datetime id, which keeps one Fact per hour.
+    index = {}
+    for batch in _planBatches(allRequests):
+        for fact in _fetchFacts(*batch):
+            index.setdefault((fact.stationId,fact.elementId),{}).setdefault(fact.datetimeId,fact)
+    datetimeIds = {}
+    for (key,factsByDatetime) in index.items():
+        datetimeIds[key] = sorted(factsByDatetime.keys())
+        index[key] = [factsByDatetime[datetimeId] for datetimeId in datetimeIds[key]]
     
-    factList = _asFactList(queryResults)
-    return FactCollection(factList)
+    results = []
+    for (stationIds,ranges,elementIds) in parsed:
+        factList = []
+        for stationId in stationIds:
+            for elementId in elementIds:
+                key = (stationId,elementId)
+                if key not in index: continue
+                ids = datetimeIds[key]
+                for (begin,end) in ranges:
+                    factList.extend(index[key][bisect_left(ids,begin):bisect_right(ids,end)])
+        results.append(FactCollection(factList))
+    return results
 
 querySizeOverrideAllowed = False
 def allowQuerySizeOverride():
@@ -106,9 +314,9 @@ def subhourly(*data):
             newfact.subhourlyTime # Calling this ensures it's populated *before* the element id is overwritten 
             newfact.element  = Element(fact.subhourlyId,fact.subhourlyName,
                                        fact.subhourlyDescription)
-            newfact.datetime = Datetime(fact.datetimeId-1,
-                                        fact.datetime.previous().datetime0_23+
-                                        fact.subhourlyTime)
+            newfact.datetime = _subhourlyDatetime(fact.datetimeId-1,
+                                                  _stringFromDatetimeId(fact.datetimeId-1)+
+                                                  fact.subhourlyTime)
             newfact.elementId = fact.subhourlyId
             newfact.datetimeId = newfact.datetime.datetimeId
             ''' If I want to replace 60 with 00 here, use this instead:
@@ -147,10 +355,340 @@ def _asFactList(data):
         pass # no problem if not
     return [Fact(r) for r in data]
 
-def _queryTooLarge(stations,begin,end,elements):
-    ''' Returns True if number of facts requested is too large. '''
+def _planRequests(stations,datetimes,elements):
+    ''' Handles getData()'s input parameters: resolves them, clips them to each station's period of record,
+        enforces the query size limit, and returns a list of (stationIds,begin,end,elementIds) requests, one
+        per distinct range. datetimes may be a list of ranges (see _parseDatetimeRanges()), in which case the
+        requests for each are returned together. '''
+    freshenGlobals()
+    
+    stations = [s.stationId for s in findStations(stations)]
+    allRanges = [_clipToPor(stations,begin,end) for (begin,end) in _parseDatetimeRanges(datetimes)]
+    _checkQuerySize(allRanges,elements)
+
+    elementIds = [s.elementId for s in findElements(elements)]
+    
+    requests = []
+    for ranges in allRanges:
+        requests.extend([(ids,rangeBegin,rangeEnd,elementIds) for ((rangeBegin,rangeEnd),ids) in _groupByRange(ranges).items()])
+    return requests
+
+def _checkQuerySize(allRanges,elements):
+    ''' Ensures a query is not too big: takes a list of dicts from station id to clipped (begin,end) (see 
+        _clipToPor()) and raises an Exception if they add up to too many facts, unless allowQuerySizeOverride() 
+        has been called, in which case the override is used up. '''
+    global querySizeOverrideAllowed
+    if (querySizeOverrideAllowed):
+        querySizeOverrideAllowed = False
+    else:
+        stationHours = sum([_stationHours(ranges) for ranges in allRanges])
+        if _queryTooLarge(stationHours,elements):
+            numStations = len(Set([stationId for ranges in allRanges for stationId in ranges]))
+            raise Exception("Query size too large. Aborting. ("+str(numStations)+" stations, "+
+                            str(stationHours)+" station-hours, "+str(_length(elements))+" elements).")
+
+def _fetchAll(requests):
+    ''' Retrieves a list of (stationIds,begin,end,elementIds) requests, returning a single list of Facts. The
+        requests are packed into as few queries as possible (see _planBatches()), and anything the packed 
+        queries pick up which wasn't requested, or which more than one of them picks up, is dropped. '''
+    if len(requests) == 1:
+        return _fetchFacts(*requests[0])
+    factList = []
+    for batch in _planBatches(requests):
+        factList.extend(_fetchFacts(*batch))
+    return _keepRequested(factList,requests)
+
+def _fetchColumnar(requests):
+    ''' Retrieves a list of (stationIds,begin,end,elementIds) requests into a single FactStore, one chunk of
+        no more than MAXQUERYSIZE facts at a time, so that only one chunk's worth of Facts exists at once
+        (which is also why the session cache is bypassed). '''
+    store = FactStore()
+    for request in requests:
+        for (chunkStations,chunkBegin,chunkEnd,chunkElements) in _planChunks(request[0],request[1],request[2],request[3],MAXQUERYSIZE):
+            facts = _fetchFacts(chunkStations,chunkBegin,chunkEnd,chunkElements,sessionCache=False)
+            started = time.time()
+            store.extend(facts)
+            _record("columnar",started,len(facts))
+    return store
+
+def _keepRequested(facts,requests):
+    ''' Returns those facts which fall within one of a list of (stationIds,begin,end,elementIds) requests for 
+        the same elements, whose ranges for any one station don't overlap (as from _planRequests()). The 
+        batches from _planBatches() can overlap even so, so each fact is kept only the first time it turns up. '''
+    rangesByStation = {}
+    for (stationIds,begin,end,elementIds) in requests:
+        for stationId in stationIds:
+            rangesByStation.setdefault(stationId,[]).append((begin,end))
+    beginsByStation = {}
+    for (stationId,ranges) in rangesByStation.items():
+        ranges.sort()
+        beginsByStation[stationId] = [begin for (begin,end) in ranges]
+    
+    kept = []
+    seen = Set()
+    for fact in facts:
+        if fact.stationId not in rangesByStation: continue
+        i = bisect_right(beginsByStation[fact.stationId],fact.datetimeId) - 1
+        if i >= 0 and fact.datetimeId <= rangesByStation[fact.stationId][i][1]:
+            key = (fact.stationId,fact.elementId,fact.datetimeId)
+            if key not in seen:
+                seen.add(key)
+                kept.append(fact)
+    return kept
+
+def _fetchFacts(stationIds,begin,end,elementIds,sessionCache=True):
+    ''' Retrieves the Facts for a list of station ids, a begin and end datetime id, and a list of element 
+        ids, with no checks on the size of the query. Returns a list of Facts. Goes through the session cache
+        (unless sessionCache is False) and the local fact cache (see dsl.cache), so only data which aren't 
+        already cached are requested from the database. '''
+    return _fetchThroughCaches(stationIds,begin,end,elementIds,_queryFacts,sessionCache)
+
+def _queryFacts(stationIds,begin,end,elementIds):
+    ''' Requests Facts from the database (bypassing any caching). Takes the same parameters as _fetchFacts(). '''
+    # Create a map of parameters in the form that ElementDao wants
+    params = HashMap()
+    params["stationIds"] = stationIds
+    params["begin"] = begin
+    params["end"]   = end
+    params["elementIds"] = elementIds
+    started = time.time()
+    elementValues = elementDao.getElementValues(params)
+    _record("dao",started,elementValues.size(),elementValues.size() * ELEMENTVALUEBYTES)
+    started = time.time()
+    facts = _asFactList(elementValues)
+    _record("conversion",started,len(facts),len(facts) * FACTBYTES)
+    return facts
+
+def _fetchFactsParallel(requests):
+    ''' Takes a list of (stationIds,begin,end,elementIds) requests, splits them into pieces, and retrieves 
+        the pieces simultaneously on a bounded pool of threads. Returns a single list of Facts. '''
+    numThreads = _poolSize()
+    if len(requests) >= numThreads:
+        pieces = requests
+    else:
+        piecesPerRequest = -(-numThreads // max(1,len(requests))) # ie ceil(numThreads/len(requests))
+        pieces = []
+        for (stationIds,begin,end,elementIds) in requests:
+            pieces.extend(_planPieces(stationIds,begin,end,elementIds,piecesPerRequest))
+    if len(pieces) < 2: # Nothing to be gained from extra threads
+        factList = []
+        for piece in pieces:
+            factList.extend(_fetchFacts(*piece))
+        return factList
+    
+    executor = Executors.newFixedThreadPool(min(numThreads,len(pieces)),_DaemonThreadFactory())
+    try:
+        futures = [executor.submit(_FetchTask(*piece)) for piece in pieces]
+        factList = []
+        for future in futures: # Merge in the order submitted so the results are deterministic
+            try:
+                factList.extend(future.get())
+            except ExecutionException, e: # Rethrow whatever went wrong in the worker thread
+                raise e.getCause()
+    finally:
+        executor.shutdownNow()
+    return factList
+
+def _fetchAsync(stationIds,begin,end,elementIds):
+    ''' Starts retrieving the given stations, range and elements on getDataAsync()'s thread pool, clipped to
+        each station's period of record, and returns the handle. '''
+    requests = [(ids,rangeBegin,rangeEnd,elementIds) for ((rangeBegin,rangeEnd),ids) in 
+                _groupByRange(_clipToPor(stationIds,begin,end)).items()]
+    return _DataFuture(_asyncExecutor().submit(_GetDataTask(requests)))
+
+def _planWindows(begin,end,window,overlap):
+    ''' Returns a list of (windowBegin,windowEnd,newBegin) for iterWindows(), where newBegin is the first hour
+        of the window which wasn't already in the window before it. '''
+    windows = []
+    windowBegin = begin
+    seen = begin - 1
+    while True:
+        windowEnd = min(windowBegin + window - 1, end)
+        windows.append((windowBegin,windowEnd,max(windowBegin,seen + 1)))
+        if windowEnd >= end: break
+        seen = windowEnd
+        windowBegin += window - overlap
+    return windows
+
+def _planPieces(stationIds,begin,end,elementIds,numPieces):
+    ''' Splits a request into at most numPieces (stationIds,begin,end,elementIds) tuples of roughly equal 
+        size: by station if there are several stations, otherwise by time block. '''
+    stationIds = sorted(stationIds)
+    if len(stationIds) > 1:
+        numPieces = min(numPieces,len(stationIds))
+        return [(stationIds[i::numPieces],begin,end,elementIds) for i in range(numPieces)]
+    hours = end + 1 - begin
+    numPieces = max(1,min(numPieces,hours))
+    blockSize = -(-hours // numPieces) # ie ceil(hours/numPieces)
+    return [(stationIds,blockBegin,min(blockBegin + blockSize - 1, end),elementIds) 
+            for blockBegin in range(begin,end+1,blockSize)]
+
+def _poolSize():
+    ''' Returns the number of queries which can usefully be run at once: MAXTHREADS, or fewer if the 
+        connection pool won't hand out that many connections. '''
+    try:
+        maxActive = dataSource.getMaxActive()
+    except AttributeError: # Not a commons-dbcp BasicDataSource
+        return MAXTHREADS
+    if maxActive <= 0: # dbcp's convention for "no limit"
+        return MAXTHREADS
+    return min(MAXTHREADS,maxActive)
+
+class _FetchTask(Callable):
+    ''' Wraps a call to _fetchFacts() so that it can be handed to a java executor. '''
+    def __init__(self,stationIds,begin,end,elementIds):
+        self.args = (stationIds,begin,end,elementIds)
+    def call(self):
+        return _fetchFacts(*self.args)
+
+class _GetDataTask(Callable):
+    ''' Wraps the retrieval for getDataAsync() so that it can be handed to a java executor. '''
+    def __init__(self,requests):
+        self.requests = requests
+    def call(self):
+        return FactCollection(_fetchAll(self.requests))
+
+class _DataFuture(object):
+    ''' The handle returned by getDataAsync(); wraps a java Future. '''
+    def __init__(self,future):
+        self._future = future
+    def get(self,timeout=None):
+        ''' Waits for the data and returns it as a FactCollection. If timeout (in seconds) is given and the 
+            data still aren't available after that long, raises java's TimeoutException. Anything which 
+            went wrong on the background thread is raised here. '''
+        try:
+            if timeout is None:
+                return self._future.get()
+            return self._future.get(long(timeout * 1000),TimeUnit.MILLISECONDS)
+        except ExecutionException, e: # Rethrow whatever went wrong in the worker thread
+            raise e.getCause()
+    def isDone(self):
+        return self._future.isDone()
+    def cancel(self):
+        ''' Abandons the request if it hasn't finished yet. Returns False if it couldn't be cancelled. '''
+        return self._future.cancel(True)
+
+_asyncExecutorInstance = None
+def _asyncExecutor():
+    ''' Returns the thread pool shared by all getDataAsync() calls, creating it on first use. Like 
+        getDataParallel(), it's bounded by the size of the connection pool. '''
+    global _asyncExecutorInstance
+    if _asyncExecutorInstance is None:
+        _asyncExecutorInstance = Executors.newFixedThreadPool(_poolSize(),_DaemonThreadFactory())
+    return _asyncExecutorInstance
+
+class _DaemonThreadFactory(ThreadFactory):
+    ''' Creates daemon threads, so that worker threads never keep a finished script from exiting. '''
+    def newThread(self,runnable):
+        thread = Thread(runnable)
+        thread.setDaemon(True)
+        return thread
+
+def _planChunks(stationIds,begin,end,elementIds,chunkSize):
+    ''' Splits a request into a list of (stationIds,begin,end,elementIds) tuples, each of which covers no more 
+        than chunkSize facts. Elements are only split up if a single station-hour is too big, and stations only 
+        if a single hour for all stations is too big; whatever room is left over goes to the time block. 
+        Chunks are ordered by time block, then station, then element. '''
+    if not stationIds or not elementIds or end < begin:
+        return []
+    stationIds = sorted(stationIds)
+    elementsPerChunk = min(len(elementIds),chunkSize)
+    stationsPerChunk = min(len(stationIds),max(1,chunkSize // elementsPerChunk))
+    hoursPerChunk    = max(1,chunkSize // (stationsPerChunk * elementsPerChunk))
+    
+    chunks = []
+    for blockBegin in range(begin,end+1,hoursPerChunk):
+        blockEnd = min(blockBegin + hoursPerChunk - 1, end)
+        for s in range(0,len(stationIds),stationsPerChunk):
+            for e in range(0,len(elementIds),elementsPerChunk):
+                chunks.append((stationIds[s:s+stationsPerChunk],blockBegin,blockEnd,elementIds[e:e+elementsPerChunk]))
+    return chunks
+
+def _runs(datetimeIds):
+    ''' Takes a list of datetime ids and returns a sorted list of (begin,end) pairs covering runs of 
+        consecutive ids. '''
+    runs = []
+    for datetimeId in sorted(datetimeIds):
+        if runs and datetimeId <= runs[-1][1] + 1:
+            runs[-1] = (runs[-1][0],max(runs[-1][1],datetimeId))
+        else:
+            runs.append((datetimeId,datetimeId))
+    return runs
+
+def _planBatches(requests):
+    ''' Merges (stationIds,begin,end,elementIds) requests into as few queries as possible for getDataMany(). 
+        Requests for the same elements are taken in datetime order and merged into the current query as long
+        as it stays under MAXQUERYSIZE and asks for no more than BATCHWASTE times the facts actually requested 
+        (so that eg requests for one hour in January and one in December don't pull the whole year). Returns
+        a list of (stationIds,begin,end,elementIds) queries. '''
+    byElements = {}
+    for (stationIds,begin,end,elementIds) in requests:
+        if not stationIds or not elementIds: continue
+        byElements.setdefault(tuple(sorted(elementIds)),[]).append((begin,end,stationIds))
+    
+    batches = []
+    for (elementIds,ranges) in byElements.items():
+        ranges.sort()
+        batch = None # (Set of station ids, begin, end, facts requested)
+        for (begin,end,stationIds) in ranges:
+            requested = len(stationIds) * (end+1 - begin) * len(elementIds)
+            if batch:
+                (batchStations,batchBegin,batchEnd,batchRequested) = batch
+                mergedStations = batchStations.union(stationIds)
+                mergedEnd = max(batchEnd,end)
+                mergedSize = len(mergedStations) * (mergedEnd+1 - batchBegin) * len(elementIds)
+                if mergedSize <= MAXQUERYSIZE and mergedSize <= BATCHWASTE * (batchRequested + requested):
+                    batch = (mergedStations,batchBegin,mergedEnd,batchRequested + requested)
+                    continue
+                batches.append((sorted(batchStations),batchBegin,batchEnd,list(elementIds)))
+            batch = (Set(stationIds),begin,end,requested)
+        (batchStations,batchBegin,batchEnd,batchRequested) = batch
+        batches.append((sorted(batchStations),batchBegin,batchEnd,list(elementIds)))
+    return batches
+
+def _clipToPor(stationIds,begin,end):
+    ''' The query planner: intersects the requested range of datetime ids with each station's period of record,
+        so that we never ask for (or count toward the query limit) hours before a station existed or after it 
+        stopped reporting. Returns a dict from station id to a clipped (begin,end) pair; stations whose POR 
+        doesn't overlap the range at all are left out. The end of the range is only clipped for stations 
+        whose POR ended well before "now", since an active station's POR moves on while we're working. Stations
+        with no POR are left unclipped. '''
+    pors = _cachedPors(list(stationIds) + [NOWSTATIONID])
+    nowPor = pors[NOWSTATIONID]
+    now = nowPor and nowPor.getEndDatetime()
+    ranges = {}
+    for stationId in stationIds:
+        por = pors[stationId]
+        if por is None:
+            ranges[stationId] = (begin,end)
+            continue
+        clippedBegin = max(begin,por.getStartDatetime())
+        clippedEnd = end
+        if now is None or por.getEndDatetime() < now - PORENDSLACK: # Station has stopped reporting
+            clippedEnd = min(end,por.getEndDatetime())
+        if clippedBegin <= clippedEnd:
+            ranges[stationId] = (clippedBegin,clippedEnd)
+    return ranges
+
+def _groupByRange(ranges):
+    ''' Takes a dict from station id to (begin,end) and returns a dict from (begin,end) to a sorted list of 
+        the station ids with that range, so that stations with the same range can share a query. '''
+    grouped = {}
+    for (stationId,stationRange) in ranges.items():
+        grouped.setdefault(stationRange,[]).append(stationId)
+    for stationIds in grouped.values():
+        stationIds.sort()
+    return grouped
+
+def _stationHours(ranges):
+    ''' Returns the total number of station-hours in a dict from station id to (begin,end). '''
+    return sum([end+1 - begin for (begin,end) in ranges.values()])
+
+def _queryTooLarge(stationHours,elements):
+    ''' Returns True if number of facts requested is too large. Takes the number of station-hours requested
+        (see _stationHours()). '''
     elementlength = 1 if isinstance(elements,str) else _length(elements) # Slightly fancier handling because getData hasn't called findElements (because it has to separate out soil elements). Can change this once soil els are in the DB.
-    querysize = _length(stations) * (end+1 - begin) * elementlength
+    querysize = stationHours * elementlength
     return querysize > MAXQUERYSIZE
 
 def __doctests():
@@ -266,6 +804,183 @@ def __doctests():
     AK Barrow 4 ENE, 2010101009, T_OFFICIAL: -6.3 (0)
     AK Barrow 4 ENE, 2010101010, T_OFFICIAL: -6.5 (0)
     AK Barrow 4 ENE, 2010101011, T_OFFICIAL: -6.3 (0)
+
+    iterData() takes the same parameters as getData() but hands the data back a chunk at a time:
+    >>> chunks = list(iterData("stillwater",("10/10/10 10:00","+2"),("temp","precip"),chunkSize=4))
+    >>> [len(chunk) for chunk in chunks]
+    [4, 4, 4]
+    >>> printlist(chunks[0])
+    OK Stillwater 2 W, 2010101010, P_OFFICIAL: 0 (0)
+    OK Stillwater 2 W, 2010101010, T_OFFICIAL: 12.2 (0)
+    OK Stillwater 5 WNW, 2010101010, P_OFFICIAL: 0 (0)
+    OK Stillwater 5 WNW, 2010101010, T_OFFICIAL: 10.5 (0)
+    >>> len(list(iterData("stillwater",("10/10/10 10:00","+2"),("temp","precip"),byFact=True)))
+    12
+
+    getDataParallel() (or getData() with parallel=True) returns the same data as getData():
+    >>> d = getDataParallel("stillwater",("10/10/10 10:00","+2"),("temp","precip"))
+    >>> sorted(d.factlist) == sorted(getData("stillwater",("10/10/10 10:00","+2"),("temp","precip")).factlist)
+    True
+    >>> len(d.forStation("Stillwater 5"))
+    6
+
+    getDataAsync() hands back the same data, via get():
+    >>> pending = getDataAsync("stillwater",("10/10/10 10:00","+2"),("temp","precip"))
+    >>> sorted(pending.get().factlist) == sorted(getData("stillwater",("10/10/10 10:00","+2"),("temp","precip")).factlist)
+    True
+    >>> pending.isDone()
+    True
+
+    Requests are clipped to each station's period of record, so stations which didn't exist yet cost nothing:
+    >>> ranges = _clipToPor([1007],72255-100000,72255)
+    >>> ranges[1007] == (getPor(1007).getStartDatetime(),72255)
+    True
+
+    iterWindows() yields a FactCollection per window, reusing the hours each window shares with the last:
+    >>> _planWindows(0,9,4,1)
+    [(0, 3, 0), (3, 6, 4), (6, 9, 7)]
+    >>> [len(w) for w in iterWindows("stillwater 5",("10/10/10 1:00","+35"),"temp",window=12,overlap=6)]
+    [12, 12, 12, 12, 12]
+    >>> windows = list(iterWindows("stillwater",("10/10/10 10:00","+2"),("temp","precip"),window=2,prefetch=2))
+    >>> [len(w) for w in windows]
+    [8, 4]
+    >>> begin = getPor("barrow").getStartDatetime()
+    >>> len(list(iterWindows("barrow",(begin-130000,begin),"temp",window=130001))) # Only one hour is in the POR
+    1
+
+    getDataSince() only returns facts whose observations were loaded after the watermark:
+    >>> (d,watermark) = getDataSince("stillwater",("10/10/10 10:00","+2"),("temp","precip"))
+    >>> len(d)
+    12
+    >>> (d,newWatermark) = getDataSince("stillwater",("10/10/10 10:00","+2"),("temp","precip"),watermark)
+    >>> (len(d),newWatermark == watermark)
+    (0, True)
+    >>> _runs([5,3,4,9,10,12])
+    [(3, 5), (9, 10), (12, 12)]
+
+    getDataMany() returns one FactCollection per request, the same as separate getData() calls would:
+    >>> requests = [("stillwater 5","2010101010","temp"),("stillwater 5",("2010101011","+1"),"temp"),
+    ...             ("stillwater 2","2010101010",("temp","precip"))]
+    >>> many = getDataMany(requests)
+    >>> [len(d) for d in many]
+    [1, 2, 2]
+    >>> [sorted(d.factlist) == sorted(getData(*r).factlist) for (d,r) in zip(many,requests)]
+    [True, True, True]
+
+    Batches can overlap, by element or (when a merge is refused) by station and hour, but each request still 
+    gets each Fact just once:
+    >>> requests = [("stillwater 2","2010101010","temp"),("stillwater 2",("2010101010","+1"),("temp","precip"))]
+    >>> [sorted(d.factlist) == sorted(getData(*r).factlist) for (d,r) in zip(getDataMany(requests),requests)]
+    [True, True]
+    >>> _planBatches([([1006],87793,87893,[343]),(range(1006,1056),87843,87843,[343])])[1][1:3]
+    (87843, 87843)
+    >>> requests = [("stillwater 5",(87793,87893),"temp"),(getAllStations(),87843,"temp")]
+    >>> [sorted(d.factlist) == sorted(getData(*r).factlist) for (d,r) in zip(getDataMany(requests),requests)]
+    [True, True]
+
+    getDataMany(), iterData() and getDataSince() take lists of ranges too:
+    >>> ranges = [(87793,87793),(87796,"+1")]
+    >>> expected = sorted(getData("stillwater 5",ranges,"temp").factlist)
+    >>> sorted(getDataMany([("stillwater 5",ranges,"temp")])[0].factlist) == expected
+    True
+    >>> sorted(iterData("stillwater 5",ranges,"temp",byFact=True)) == expected
+    True
+    >>> sorted(getDataSince("stillwater 5",ranges,"temp")[0].factlist) == expected
+    True
+    >>> list(iterWindows("stillwater 5",ranges,"temp"))
+    Traceback (most recent call last):
+    ...
+    ValueError: Expected a single datetime or range here, not a list of ranges
+    >>> len(_planBatches([([1006],87793,87793,[343]),([1006],87794,87795,[343]),([1005],87793,87793,[318,343])]))
+    2
+
+    getData() takes a list of ranges; it returns just the hours asked for, however the queries are packed:
+    >>> d = getData("stillwater 5",[(87793,87793),(87796,"+1"),(87794,87794)],"temp")
+    >>> sorted([f.datetimeId for f in d])
+    [87793, 87794, 87796, 87797]
+    >>> sorted(d.factlist) == sorted(getData("stillwater 5",(87793,87794),"temp").factlist + getData("stillwater 5",(87796,87797),"temp").factlist)
+    True
+    >>> facts = _fetchAll([([1005,1006],87793,87793,[343]),([1006],87795,87795,[343])])
+    >>> sorted([(f.stationId,f.datetimeId) for f in facts])
+    [(1005, 87793), (1006, 87793), (1006, 87795)]
+
+    When stations' PORs differ, one station can turn up in batches which overlap in time; it still gets each 
+    hour once:
+    >>> requests = [([1005],87793,87843,[343]),([1006],87813,88693,[343]),(range(1007,1057),87893,87893,[343]),([1005],87993,88093,[343])]
+    >>> [(batch[0][:2],batch[1],batch[2]) for batch in _planBatches(requests)]
+    [([1005, 1006], 87793, 88693), ([1007, 1008], 87893, 87893), ([1005], 87993, 88093)]
+    >>> facts = _fetchAll(requests)
+    >>> len(facts) == len(Set([(f.stationId,f.elementId,f.datetimeId) for f in facts]))
+    True
+    >>> sorted(facts) == sorted(_fetchAll(requests[:2]) + _fetchAll(requests[2:]))
+    True
+    >>> ranges = [("2009010100","+23"),("2010101000","+23")]
+    >>> d = getData(getAllStations(),ranges,"temp")
+    >>> len(d) == len(Set([(f.stationId,f.elementId,f.datetimeId) for f in d]))
+    True
+    >>> sorted(d.factlist) == sorted(getData(getAllStations(),ranges[0],"temp").factlist + getData(getAllStations(),ranges[1],"temp").factlist)
+    True
+
+    columnar=True gives the same Facts, grouped the same way, from a FactStore:
+    >>> d = getData("stillwater",("10/10/10 1:00","+35"),("temp","precip"))
+    >>> c = getData("stillwater",("10/10/10 1:00","+35"),("temp","precip"),columnar=True)
+    >>> (type(c.factlist).__name__,len(c) == len(d))
+    ('FactStore', True)
+    >>> sorted(c.factlist) == sorted(d.factlist)
+    True
+    >>> [len(c.forLocalDay(day)) for day in c.localDays] == [len(d.forLocalDay(day)) for day in d.localDays]
+    True
+    >>> [day for day in d.localDays if list(c.forLocalDay(day)) != list(d.forLocalDay(day))]
+    []
+    >>> type(c.forStation("stillwater 5").factlist).__name__
+    'FactStore'
+    >>> list(c.forStation("stillwater 5")) == list(d.forStation("stillwater 5"))
+    True
+    >>> list(c.forElement("temp")) == list(d.forElement("temp"))
+    True
+    >>> str(c) == str(d)
+    True
+    >>> [f.value for f in c[:3]] == [c.factlist.value(i) for i in range(3)]
+    True
+    >>> c.factlist[0:1] = []
+    Traceback (most recent call last):
+    ...
+    TypeError: FactStore doesn't support slice assignment
+
+    5-minute Facts come in the same order too (by datetime, 5-minute period, station, then element):
+    >>> d = getData(("asheville 8","asheville 13"),"2009123108",("calculated average temp for 5 minutes","temp"))
+    >>> c = getData(("asheville 8","asheville 13"),"2009123108",("calculated average temp for 5 minutes","temp"),columnar=True)
+    >>> list(c.forLocalDay("20091231")) == list(d.forLocalDay("20091231"))
+    True
+    >>> [f.subhourlyTime for f in d.forLocalDay("20091231")][:6]
+    [None, None, '05', '05', '10', '10']
+
+    Facts from subhourly() keep their minutes, so adding them to a columnar FactCollection switches it to a list:
+    >>> c = getData("asheville 8","2009123108","calculated average temp for 5 minutes",columnar=True)
+    >>> s = subhourly("asheville 8","2009123108","calculated average temp for 5 minutes")
+    >>> both = c + s
+    >>> (type(both.factlist).__name__,[f.datetime for f in both.factlist[len(c):]] == [f.datetime for f in s])
+    ('list', True)
+    >>> c.extend(s)
+    >>> (type(c.factlist).__name__,[f.subhourlyTime for f in c.factlist[-len(s):]] == [f.subhourlyTime for f in s])
+    ('list', True)
+    >>> FactStore(s)
+    Traceback (most recent call last):
+    ...
+    ValueError: A FactStore can't hold subhourly() Facts; keep them in a list
+
+    sum(), mean(), min(), max() and differences() work on the integer values, but give the same Decimals:
+    >>> d = getData("stillwater 5",("10/10/10 1:00","+35"),"temp")
+    >>> values = [f.value for f in d]
+    >>> [str(x) for x in (d.sum(),d.mean(),d.min(),d.max())] == [str(x) for x in (sum(d),sum(d)/len(d),min(values),max(values))]
+    True
+    >>> [str(x) for x in d.differences()] == [str(b - a) for (a,b) in zip(values,values[1:])]
+    True
+    >>> c = getData("stillwater 5",("10/10/10 1:00","+35"),"temp",columnar=True)
+    >>> [str(x) for x in (c.sum(),c.min(),c.max())] == [str(x) for x in (d.sum(),d.min(),d.max())]
+    True
+    >>> FactCollection([]).sum()
+    0
         
 '''
 
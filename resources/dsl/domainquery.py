@@ -17,12 +17,58 @@ from datetime import tzinfo
 import parsedatetime.parsedatetime as pdt 
 import parsedatetime.parsedatetime_consts as pdc
 import java.util.Map as Map
-import time,re
+import java.util.ArrayList as List
+import java.io.ObjectInputStream as ObjectInputStream
+import java.io.ObjectOutputStream as ObjectOutputStream
+import java.io.BufferedInputStream as BufferedInputStream
+import java.io.BufferedOutputStream as BufferedOutputStream
+import java.io.FileInputStream as FileInputStream
+import java.io.FileOutputStream as FileOutputStream
+import os,sys,time,re,threading
+from collections import deque
+from itertools import izip
 from ElementSubhourlyGroupManager import ElementSubhourlyGroupManager
-# Maintain global variables for allstations and allelements, with an associated load time
+from dsl.stats import _instrumented, _counted, _record
+from dsl.utils import _executeQuery, _LRUCache, _userDataDirectory
+# Maintain global variables for allstations and allelements, with an associated load time. After the first
+# load, they're reloaded in the background and the new set is swapped in whole (see freshenGlobals()), so
+# code using them should pick up each one once (eg into a local variable) rather than assume they stay put.
 allstations = None # loaded with the list of stations the 1st time it's needed
 allelements = None
+allpors = None # station id -> POR for every station with one (see _porRegistry()), loaded with the other globals
+stationindex = None # a _StationIndex of allstations, rebuilt by freshenGlobals()
+elementindex = None # an _ElementIndex of allelements, rebuilt by freshenGlobals()
 globalloadtime = 0
+globalgeneration = 0 # goes up by one each time a newly loaded set of globals is swapped in
+GLOBALSMAXAGE = 1800 # Seconds before the globals are reloaded
+GLOBALSRETRYDELAY = 60 # Seconds before trying again if reloading them fails
+_globalsLock = threading.Lock()
+_globalsRefreshing = False # True while a background reload is under way
+globalsfromsnapshot = False # True until globals read from the metadata snapshot have been checked against the database
+
+# The globals are saved to disk after each load, so that a new session can start from them straight away
+# (and check them against the database in the background) instead of waiting on the database.
+METADATASNAPSHOTVERSION = 1 # Bump whenever the format of the snapshot changes; older snapshots are then ignored
+
+NOWSTATIONID = 1631 # A representative station; the datetime of its latest observation is treated as "now"
+STATIONQUERYCACHESIZE = 1000 # Number of distinct findStations() queries remembered
+ELEMENTQUERYCACHESIZE = 1000 # Number of distinct findElements() pattern queries remembered
+REGEXCACHESIZE = 500 # Number of compiled search patterns remembered
+
+# Datetime ids count hours from 2000-10-04 09:00 UTC (id 0), so Datetimes can be worked out locally rather than 
+# looked up with datetimeDao. We only need the database for the range of the datetime table.
+DATETIMEEPOCH = (2000,10,4,9)
+datetimebounds = None # (first,last) datetime id in the datetime table, loaded by freshenGlobals()
+
+# Datetimes are interned, so that all the Facts (and grouping keys) for one hour share a single Datetime. The 
+# tables are bounded; once one is full, the longest-held Datetimes are dropped to make room. Since they're 
+# shared, treat Datetimes as immutable.
+DATETIMEINTERNSIZE = 20000 # per table; a Datetime (with its Calendar) is roughly half a kilobyte
+_internedDatetimes = {} # datetime id -> Datetime
+_internedDatetimeOrder = deque()
+_internedSubhourly = {} # (datetime id, YYYYMMDDHHmm) -> Datetime, for the Datetimes created by subhourly()
+_internedSubhourlyOrder = deque()
+_internLock = threading.Lock()
 
 # Maintain a list of commonly-requested elements:
 elaliases = {"wind":"WINDSPD", "solar":"SOLARAD", "infrared":"SUR_TEMP", "battery":"BV_DL",
@@ -49,6 +95,7 @@ class _UTC(tzinfo):
     def dst(self, dt):
         return self.ZERO
 
+@_counted("findStations")
 def findStations(*params):
     ''' Finds a station or stations based on station id, name, WBAN, etc (anything that 
         appears in the resulting string), or a list of any of the above. Special case: if 
@@ -63,23 +110,62 @@ def findStations(*params):
     stations = []
     for identifier in identifiers: # separate cases follow for int, Station, other
         if isinstance(identifier,int):
+            if identifier not in allstations.keySet(): _confirmGlobals()
             if identifier not in allstations.keySet(): raise KeyError(str(identifier)+" is not a valid station id")
             stations.append(allstations[identifier])
         elif isinstance(identifier,Station):
             stations.append(identifier)
         else:
             identstring = str(identifier)
-            if (re.match("^\d\d\d\d$",identstring)): # Special case: 4-digit station id; surround with brackets to ensure 
-                identstring = "\["+identstring+"\]"  # no other matches
-            matches = [s for s in allstations.values() if re.search(identstring,str(s),_caseStrategy(identstring))]
-            if not matches: raise KeyError("No stations matching "+identstring)
+            matches = stationindex.find(identstring)
+            if not matches and _confirmGlobals():
+                matches = stationindex.find(identstring)
+            if not matches:
+                if (re.match("^\d\d\d\d$",identstring)): identstring = "\["+identstring+"\]" # As searched for
+                raise KeyError("No stations matching "+identstring)
             stations.extend(matches)
     return list(set(stations)) # Convert to set for uniqueness, then back to list for convenience
         
+class _StationIndex(object):
+    ''' Lookup tables for findStations(), built from allstations whenever the globals are refreshed. A query
+        which is exactly a station's WBAN, name or "ST City" is answered from a hash map, and a 4-digit query
+        from the map of station ids. Other plain-text queries are answered with a substring scan of the 
+        stations' precomputed strings, and only genuine patterns are run as (precompiled) regexes. Answers 
+        are remembered, so a repeated query costs a dict lookup. Every answer is exactly what a regex search 
+        of each station's string (with smartcase) would give. '''
+    def __init__(self,stations):
+        self.byId = dict([(s.stationId,s) for s in stations])
+        self.searchStrings = [(s,str(s),str(s).lower()) for s in stations]
+        self.exact = {}
+        for s in stations:
+            name = s.getName()
+            for key in (s.getWbanno(),s.getNameString(),"%s %s" % (name.getState(),name.getLocation())):
+                if not key: continue
+                for k in (key,key.lower()):
+                    if k not in self.exact:
+                        self.exact[k] = _search(self.searchStrings,k)
+        self.results = _LRUCache(STATIONQUERYCACHESIZE)
+
+    def find(self,identstring):
+        ''' Returns a list of the stations matching identstring. '''
+        if re.match("^\d\d\d\d$",identstring): # Special case: 4-digit station id, which matches nothing else
+            station = self.byId.get(int(identstring))
+            if station is None:
+                return []
+            return [station]
+        matches = self.exact.get(identstring)
+        if matches is None:
+            matches = self.results.get(identstring)
+        if matches is None:
+            matches = _search(self.searchStrings,identstring)
+            self.results.put(identstring,matches)
+        return matches
+
 def findStation(identifier):
     ''' Same as findStations(), but returns the first matching station it finds.    '''
     return findStations(identifier).pop()
 
+@_counted("findElements")
 def findElements(*params):
     ''' Returns elements by name search. There is a list of convenient aliases for the most 
         commonly requested elements, which can be seen with the showElements() command. If 
@@ -96,6 +182,7 @@ def findElements(*params):
     for identifier in identifiers: # separate cases follow based on parameter type
         if identifier in elaliases: identifier = elaliases[identifier]
         if isinstance(identifier,int): # int parameters are treated as element ids
+            if identifier not in allelements.keySet(): _confirmGlobals()
             if identifier not in allelements.keySet(): raise KeyError(str(identifier)+" is not a valid element id")
             elements.append(allelements[identifier])
         elif isinstance(identifier,Element): # Elements are left untouched
@@ -105,15 +192,42 @@ def findElements(*params):
             if (re.match("^\d+$",identstring)): # Special case: all digits. Cast to int and find again. 
                 elements.append(findElement(int(identstring)))
             else:
-                matches = [s for s in allelements.values() if re.search(identstring,str(s),_caseStrategy(identstring))]
+                matches = elementindex.find(identstring)
+                if not matches and _confirmGlobals():
+                    matches = elementindex.find(identstring)
                 if not matches: raise KeyError("No elements matching "+identstring)
                 elements.extend(matches)
     return list(set(elements)) # Convert to set for uniqueness, then back to list for user convenience
     
+class _ElementIndex(object):
+    ''' Lookup tables for findElements(), built from allelements (including the artificial subhourly elements)
+        whenever the globals are refreshed. Searches work as for _StationIndex. Since there are many more 
+        elements than stations, the answers for exact element names are worked out the first time each is 
+        asked for (then kept for as long as the index) rather than up front, so rebuilding stays cheap. '''
+    def __init__(self,elements):
+        self.searchStrings = [(e,str(e),str(e).lower()) for e in elements]
+        self.names = set([e.getName() for e in elements])
+        self.exact = {} # element name -> matches
+        self.results = _LRUCache(ELEMENTQUERYCACHESIZE)
+
+    def find(self,identstring):
+        ''' Returns a list of the elements matching identstring. '''
+        matches = self.exact.get(identstring)
+        if matches is None:
+            matches = self.results.get(identstring)
+        if matches is None:
+            matches = _search(self.searchStrings,identstring)
+            if identstring in self.names:
+                self.exact[identstring] = matches
+            else:
+                self.results.put(identstring,matches)
+        return matches
+
 def findElement(partialname):
     ''' Same as findElements(), but returns only one matching element '''
     return findElements(partialname).pop()
 
+@_counted("findDate")
 def findDate(date):
     ''' Returns a CRN datetime. Pass in a datestring (most any format, although yyyymmddhh is 
         native and guarantees a unique result), datetime id, python datetime, or "now". Quite 
@@ -123,24 +237,22 @@ def findDate(date):
     if type(date) == Datetime: # If the parameter's already a Datetime, just pass it back
         return date
     if date == "now": # special case. We'll grab the datetime of the most recent observation for a representative station
-        return datetimeDao.getDatetime(porDao.getPor(1631).getEndDatetime())
+        return _datetimeFromId(_porRegistry()[NOWSTATIONID].getEndDatetime())
     if type(date) == int:
-        return datetimeDao.getDatetime(date)
+        return _datetimeFromId(date)
     if type(date) == python_datetime:
-        if date.tzinfo is not None: # must convert to UTC
-            date = date.astimezone(_UTC())
-        date = date.strftime("%Y%m%d%H")
+        return _datetimeFromId(_datetimeIdFromPython(date))
     if type(date) in (str,unicode):
         try:
             dummyconversion = int(date) # Fail out of this method unless the param is a string of digits
-            #                             (to spare the expense of the trip to the DB)
-            return datetimeDao.getDatetime(date[0:10]) # Use just the 1st 10 chars -- if they passed in more, we don't care
+            #                             (to spare the expense of parsing)
+            return _datetimeFromString(date) # Uses just the 1st 10 chars -- if they passed in more, we don't care
         except: # standard forms have failed. Turn to 3rd-party parsing.
             timestruct = (dateparser.parse(date))[0]
             if timestruct == None:
                 raise ValueError("Invalid argument to findDate. Use YYYYMMDDHH or one of these: http://www.feedparser.org/docs/date-parsing.html")
             timestring = time.strftime("%Y%m%d%H",timestruct)
-            datetime =  datetimeDao.getDatetime(timestring)
+            datetime =  _datetimeFromString(timestring)
             if isinstance(datetime,Datetime):
                 return datetime
     raise ValueError("Error! Invalid argument to findDate():",date)
@@ -149,23 +261,84 @@ def dateRange(begin,end,step=1):
     ''' Allows iteration over a range of hours (inclusive beginning, exclusive end, to
         match Python convention). Typically used like 'for hour in 
         dateRange("1/1/10 8:00","1/2/10 8:00"):'. Takes an optional third argument 
-        which lets you iterate over every nth hour.
+        which lets you iterate over every nth hour. Returns a DateRange, which (like
+        xrange) also supports len(), indexing, slicing, 'in' and reversed(), and only
+        creates each Datetime when it's used. It can also be passed to getData() as
+        the datetimes.
     '''
     (begin,end) = _parseDatetimeParam((begin,end))
     if begin >= end:
         raise ValueError("Your dates are out of order! %s is >= %s"%(begin,end))
-    return (findDate(datetimeid) for datetimeid in range(begin,end,step))
+    if step < 1:
+        raise ValueError("step must be a positive number of hours")
+    return DateRange(begin,end,step)
+
+class DateRange(object):
+    ''' A range of hours, as returned by dateRange(). Works like xrange over datetime ids, but
+        hands back Datetimes. The datetimeIds property gives the ids themselves (as an xrange).
+    '''
+    def __init__(self,start,stop,step):
+        self.start = start # datetime ids, with the same meaning as for xrange
+        self.stop  = stop
+        self.step  = step
+
+    def getDatetimeIds(self):
+        return xrange(self.start,self.stop,self.step)
+    datetimeIds = property(getDatetimeIds)
+
+    def __len__(self):
+        if self.step > 0:
+            return max(0,(self.stop - self.start + self.step - 1) / self.step)
+        return max(0,(self.start - self.stop - self.step - 1) / -self.step)
+
+    def __getitem__(self,index):
+        length = len(self)
+        if isinstance(index,slice):
+            (first,last,step) = index.indices(length)
+            count = len(DateRange(first,last,step))
+            start = self.start + first * self.step
+            return DateRange(start,start + count * self.step * step,self.step * step)
+        if index < 0:
+            index += length
+        if index < 0 or index >= length:
+            raise IndexError("DateRange index out of range")
+        return _datetimeFromId(self.start + index * self.step)
+
+    def __iter__(self):
+        for datetimeId in self.datetimeIds:
+            yield _datetimeFromId(datetimeId)
+
+    def __reversed__(self):
+        if not len(self):
+            return iter([])
+        last = self.start + (len(self) - 1) * self.step
+        return iter(DateRange(last,self.start - self.step,-self.step))
+
+    def __contains__(self,date):
+        if isinstance(date,Datetime):
+            datetimeId = date.datetimeId
+        elif isinstance(date,int):
+            datetimeId = date
+        else:
+            datetimeId = findDate(date).datetimeId
+        offset = datetimeId - self.start
+        return offset % self.step == 0 and 0 <= offset / self.step < len(self)
+
+    def __repr__(self):
+        return "DateRange(%s, %s, %d)" % (_stringFromDatetimeId(self.start),_stringFromDatetimeId(self.stop),self.step)
     
+@_instrumented("getPor")
 def getPor(station):
     ''' Returns a POR object which can be used as the date argument to other methods. Takes a 
         station, stationId, or string (any of the arguments to findStation() are equally 
-        valid here).
+        valid here). PORs for all stations are loaded together and kept with the list of 
+        stations, so calling this in a loop over stations is cheap.
     '''
     try:
         stationId = findStation(station).stationId
     except:
         raise Exception("Invalid station argument to getPor().")
-    return porDao.getPor(stationId)
+    return _porRegistry().get(stationId)
 
 def getAllElements():
     ''' Provides a list of all CRN elements. '''
@@ -176,12 +349,230 @@ def getAllStations():
     freshenGlobals()
     return allstations.values()
 
+def _cachedPors(stationIds):
+    ''' Returns a dict from each of the given station ids to its POR (or to None if it has no POR). '''
+    pors = _porRegistry()
+    return dict([(s,pors.get(s)) for s in stationIds])
+
+def _porRegistry():
+    ''' Returns a dict from station id to POR for every station which has one. The PORs are loaded (all in 
+        one query) along with the rest of the globals, so they're never more than half an hour old. '''
+    global allpors
+    freshenGlobals()
+    pors = allpors # the globals may be swapped while we work
+    if pors is None: # Globals came from the snapshot, which doesn't keep PORs
+        pors = _loadPors()
+        _globalsLock.acquire()
+        try:
+            if allpors is None:
+                allpors = pors
+        finally:
+            _globalsLock.release()
+    return pors
+
+def _loadPors():
+    ''' Loads the PORs for all stations from porDao, as a dict from station id to POR. '''
+    started = time.time()
+    found = porDao.getPor()
+    pors = dict([(int(stationId),found.get(stationId)) for stationId in found.keySet()])
+    _record("porRegistry",started,len(pors))
+    return pors
+
+def _datetimeFromId(datetimeId):
+    ''' Returns the Datetime for a datetime id, worked out locally. Like datetimeDao, returns None for ids 
+        outside the datetime table. '''
+    if datetimebounds is None: freshenGlobals()
+    (first,last) = datetimebounds
+    if datetimeId < first or datetimeId > last:
+        return None
+    return _intern(_internedDatetimes,_internedDatetimeOrder,datetimeId,
+                   lambda: Datetime(datetimeId,_stringFromDatetimeId(datetimeId)))
+
+def _subhourlyDatetime(datetimeId,yyyymmddhhmm):
+    ''' Returns the (shared) Datetime for a subhourly time, eg Datetime(72254,"200812312335"). '''
+    return _intern(_internedSubhourly,_internedSubhourlyOrder,(datetimeId,yyyymmddhhmm),
+                   lambda: Datetime(datetimeId,yyyymmddhhmm))
+
+def _intern(table,order,key,create):
+    ''' Returns the value for key from an intern table, first calling create() to make it if it's not 
+        there yet. order holds the table's keys, oldest first, so that the table can be kept to 
+        DATETIMEINTERNSIZE entries. Lookups of values already in the table don't need the lock. '''
+    value = table.get(key)
+    if value is None:
+        _internLock.acquire()
+        try:
+            value = table.get(key)
+            if value is None: # Still not there now that we hold the lock
+                value = create()
+                table[key] = value
+                order.append(key)
+                if len(order) > DATETIMEINTERNSIZE:
+                    del table[order.popleft()]
+        finally:
+            _internLock.release()
+    return value
+
+def _datetimeFromString(yyyymmddhh):
+    ''' Returns the Datetime for a YYYYMMDDHH string (any further characters are ignored), or None if it isn't
+        a valid date in the datetime table. '''
+    datetimeId = _datetimeIdFromString(yyyymmddhh)
+    if datetimeId is None:
+        return None
+    return _datetimeFromId(datetimeId)
+
+def _datetimeIdFromString(yyyymmddhh):
+    ''' Converts a YYYYMMDDHH string (any further characters are ignored) to a datetime id, or returns None
+        if it isn't a valid date. As with the database's to_date(), missing fields at the end are filled in
+        with the first month, day or hour, so eg "20090101" is 2009010100. '''
+    if len(yyyymmddhh) < 4:
+        return None
+    try:
+        year = int(yyyymmddhh[0:4])
+        (month,day,hour) = [int(yyyymmddhh[i:i+2] or default) for (i,default) in ((4,1),(6,1),(8,0))]
+    except ValueError:
+        return None
+    if month < 1 or month > 12 or day < 1 or hour < 0 or hour > 23:
+        return None
+    if day > _daysFromCivil(year + month/12, month%12 + 1, 1) - _daysFromCivil(year,month,1): # past the end of the month
+        return None
+    return _daysFromCivil(year,month,day) * 24 + hour - _EPOCHHOURS
+
+def _stringFromDatetimeId(datetimeId):
+    ''' Converts a datetime id to a YYYYMMDDHH string (UTC). '''
+    (days,hour) = divmod(datetimeId + _EPOCHHOURS, 24)
+    (year,month,day) = _civilFromDays(days)
+    return "%04d%02d%02d%02d" % (year,month,day,hour)
+
+def _localStandardString(datetimeId,offset):
+    ''' Converts a datetime id to a YYYYMMDDHH string in local standard time, for a station with the given 
+        UTC offset (same as Datetime.getLstDatetime0_23(offset), without the Datetime). '''
+    return _stringFromDatetimeId(datetimeId + offset)
+
+def _pythonDatetimeFromId(datetimeId):
+    ''' Converts a datetime id to a (UTC) python datetime. '''
+    (days,hour) = divmod(datetimeId + _EPOCHHOURS, 24)
+    (year,month,day) = _civilFromDays(days)
+    return python_datetime(year,month,day,hour,0,0,0,_UTC())
+
+def _datetimeIdFromPython(date):
+    ''' Converts a python datetime to a datetime id (ignoring minutes). Datetimes without a timezone are
+        taken to be UTC. '''
+    if date.tzinfo is not None: # must convert to UTC
+        date = date.astimezone(_UTC())
+    return _daysFromCivil(date.year,date.month,date.day) * 24 + date.hour - _EPOCHHOURS
+
+def _daysFromCivil(year,month,day):
+    ''' Returns the number of days from 1970-01-01 to the given (proleptic Gregorian) date, by pure integer
+        arithmetic; see http://howardhinnant.github.io/date_algorithms.html '''
+    if month <= 2: year -= 1
+    era = (year if year >= 0 else year - 399) / 400
+    yearOfEra = year - era * 400
+    dayOfYear = (153 * (month - 3 if month > 2 else month + 9) + 2) / 5 + day - 1
+    dayOfEra = yearOfEra * 365 + yearOfEra / 4 - yearOfEra / 100 + dayOfYear
+    return era * 146097 + dayOfEra - 719468
+
+def _civilFromDays(days):
+    ''' The inverse of _daysFromCivil(): returns (year,month,day) for a number of days from 1970-01-01. '''
+    days += 719468
+    era = (days if days >= 0 else days - 146096) / 146097
+    dayOfEra = days - era * 146097
+    yearOfEra = (dayOfEra - dayOfEra / 1460 + dayOfEra / 36524 - dayOfEra / 146096) / 365
+    dayOfYear = dayOfEra - (365 * yearOfEra + yearOfEra / 4 - yearOfEra / 100)
+    shiftedMonth = (5 * dayOfYear + 2) / 153 # months counted from March
+    day = dayOfYear - (153 * shiftedMonth + 2) / 5 + 1
+    month = shiftedMonth + 3 if shiftedMonth < 10 else shiftedMonth - 9
+    year = yearOfEra + era * 400
+    if month <= 2: year += 1
+    return (year,month,day)
+
+_EPOCHHOURS = _daysFromCivil(*DATETIMEEPOCH[0:3]) * 24 + DATETIMEEPOCH[3] # hours from 1970 to datetime id 0
+
+# Stations keep local standard time all year, so the local day (or month) of a datetime at a station is 
+# integer arithmetic on the datetime id and the station's offset. Days are counted from 1970-01-01 (as in 
+# _daysFromCivil()) and months as year*12 + month-1. Hourly datetimes refer to the *end* of the observation 
+# hour, so they're moved back an hour first; subhourly datetimes (see subhourly()) already refer to the hour 
+# the observation falls in.
+_offsetTable = (None,{}) # (globalgeneration it was built from, station id -> offset from UTC in hours)
+
+def _stationOffsets():
+    ''' Returns a dict from each station id to the station's offset (in hours) from UTC. '''
+    global _offsetTable
+    freshenGlobals()
+    (generation,offsets) = _offsetTable
+    if generation != globalgeneration:
+        generation = globalgeneration
+        offsets = dict([(s.stationId,s.getOffset()) for s in allstations.values()])
+        _offsetTable = (generation,offsets)
+    return offsets
+
+def _localDayOrdinal(stationId,datetimeId,subhourly=False):
+    ''' Returns the local day (as a count of days from 1970-01-01) that a datetime falls in at a station. '''
+    hourShift = 0 if subhourly else -1
+    return (_EPOCHHOURS + datetimeId + _stationOffsets()[stationId] + hourShift) / 24
+
+def _localMonthOrdinal(stationId,datetimeId,subhourly=False):
+    ''' Returns the local month (as year*12 + month-1) that a datetime falls in at a station. '''
+    return _monthFromDay(_localDayOrdinal(stationId,datetimeId,subhourly))
+
+def _localDate(stationId,datetimeId,subhourly=False):
+    ''' Returns the local (year,month,day) that a datetime falls in at a station. '''
+    return _civilFromDays(_localDayOrdinal(stationId,datetimeId,subhourly))
+
+def _localDayString(stationId,datetimeId,subhourly=False):
+    ''' Returns the local day that a datetime falls in at a station, as 'YYYYMMDD'. '''
+    return _dayString(_localDayOrdinal(stationId,datetimeId,subhourly))
+
+def _localDayOrdinals(facts):
+    ''' Returns the local day ordinal of each of a list of Facts, in one pass. '''
+    offsets = _stationOffsets()
+    return [(_EPOCHHOURS + f.datetimeId + offsets[f.stationId] + (0 if f._isSubhourly() else -1)) / 24 for f in facts]
+
+def _localMonthOrdinals(facts):
+    ''' Returns the local month ordinal of each of a list of Facts, in one pass. '''
+    return _lookupEach(_localDayOrdinals(facts),_monthFromDay)
+
+def _localDayStrings(facts):
+    ''' Returns the local day of each of a list of Facts as 'YYYYMMDD', in one pass. '''
+    return _lookupEach(_localDayOrdinals(facts),_dayString)
+
+def _localDayStringsFromColumns(stationIds,datetimeIds,elementIds):
+    ''' Like _localDayStrings(), but takes parallel sequences of station, datetime and element ids (as kept 
+        by FactStore) rather than Facts. Element ids from 10000 up are subhourly (see Fact._isSubhourly()). '''
+    offsets = _stationOffsets()
+    ordinals = [(_EPOCHHOURS + datetimeId + offsets[stationId] + (0 if elementId >= 10000 else -1)) / 24
+                for (stationId,datetimeId,elementId) in izip(stationIds,datetimeIds,elementIds)]
+    return _lookupEach(ordinals,_dayString)
+
+def _lookupEach(keys,function):
+    ''' Returns [function(key) for key in keys], calling function only once for each distinct key. '''
+    memo = {}
+    results = []
+    for key in keys:
+        try:
+            results.append(memo[key])
+        except KeyError:
+            memo[key] = function(key)
+            results.append(memo[key])
+    return results
+
+def _monthFromDay(dayOrdinal):
+    (year,month,day) = _civilFromDays(dayOrdinal)
+    return year * 12 + month - 1
+
+def _dayString(dayOrdinal):
+    return "%04d%02d%02d" % _civilFromDays(dayOrdinal)
+
+def _monthString(monthOrdinal):
+    return "%04d%02d" % (monthOrdinal / 12, monthOrdinal % 12 + 1)
+
 def _parseDatetimeParam(datetimes):
     ''' For creating params to pass to DAO. Takes a datetime (as Datetime, YYYYMMDDHH, 
         datetime id, or "now") or a tuple of two datetimes. Returns a tuple containing the 
         "begin" param and the "end" param, each a datetime id. Also allowed is a parameter 
         of the form (d, "+24"): assuming d is any of the other valid parameter types, the 
         second parameter will be treated as a number of hours to add to d. '''
+    if _isRangeList(datetimes):
+        raise ValueError("Expected a single datetime or range here, not a list of ranges")
     if type(datetimes) in [list,tuple]:
         if isinstance(datetimes[0],int):
             begin = datetimes[0]
@@ -198,6 +589,13 @@ def _parseDatetimeParam(datetimes):
     elif type(datetimes) == POR:
         begin = datetimes.getStartDatetime()
         end   = datetimes.getEndDatetime()
+    elif isinstance(datetimes,DateRange):
+        if not len(datetimes):
+            raise ValueError("Empty DateRange")
+        if abs(datetimes.step) != 1: # Every nth hour isn't a single range (but see _parseDatetimeRanges())
+            raise ValueError("A DateRange with a step of %d hours isn't a single range" % abs(datetimes.step))
+        ends = (datetimes[0].datetimeId,datetimes[-1].datetimeId)
+        (begin,end) = (min(ends),max(ends))
     else:
         if isinstance(datetimes,int):
             begin = datetimes
@@ -206,24 +604,190 @@ def _parseDatetimeParam(datetimes):
         end   = begin
     return (begin,end)
 
-def freshenGlobals():
+def _parseDatetimeRanges(datetimes):
+    ''' Like _parseDatetimeParam(), but also takes a list of ranges (each anything _parseDatetimeParam() 
+        takes except a single datetime), eg [("2009050100","2009073123"),("2010050100","2010073123")], and
+        DateRanges with a step, each of which becomes one range per hour. Returns a sorted list of (begin,end) 
+        datetime id pairs, with overlapping and adjacent ranges merged. '''
+    parsed = []
+    for r in (datetimes if _isRangeList(datetimes) else [datetimes]):
+        if isinstance(r,DateRange) and abs(r.step) != 1 and len(r):
+            parsed.extend([(datetimeId,datetimeId) for datetimeId in r.datetimeIds])
+        else:
+            parsed.append(_parseDatetimeParam(r))
+    merged = []
+    for (begin,end) in sorted(parsed):
+        if merged and begin <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0],max(merged[-1][1],end))
+        else:
+            merged.append((begin,end))
+    return merged
+
+def _isRangeList(datetimes):
+    ''' True if datetimes is a list of ranges rather than a single range or datetime. '''
+    if type(datetimes) not in [list,tuple] or not datetimes:
+        return False
+    for item in datetimes:
+        if type(item) not in [list,tuple,POR] and not isinstance(item,DateRange):
+            return False
+    return True
+
+def freshenGlobals(wait=False):
     ''' Refreshes the lists of stations and elements. You shouldn't generally need to call 
-        this directly; it's automagically called when needed. '''
+        this directly; it's automagically called when needed. The first call reads them from 
+        the snapshot saved by an earlier session (if there is one) and checks them against the 
+        database in the background, or otherwise loads them from the database. After that, once 
+        they're half an hour old, they're reloaded on a background thread: callers carry on with 
+        the current ones, and the new ones are swapped in when they're ready. Pass wait=True to 
+        reload them from the database right away and wait until that's done. '''
+    global _globalsRefreshing
+    global globalsfromsnapshot
+    if not wait and allstations is not None and time.time() - globalloadtime <= GLOBALSMAXAGE:
+        return
+    _globalsLock.acquire()
+    try:
+        if wait or allstations is None:
+            snapshot = None
+            if not wait: # first load
+                snapshot = _readSnapshot()
+            if snapshot is None:
+                loaded = _loadGlobals()
+                _swapGlobals(loaded)
+                _writeSnapshot(loaded)
+                return
+            _swapGlobals(snapshot)
+            globalsfromsnapshot = True # and go on to check it against the database
+        elif _globalsRefreshing or time.time() - globalloadtime <= GLOBALSMAXAGE:
+            return
+        _globalsRefreshing = True
+    finally:
+        _globalsLock.release()
+    refresher = threading.Thread(target=_refreshGlobals,name="crnscript-freshenGlobals")
+    refresher.setDaemon(True) # never keep a finished script from exiting
+    refresher.start()
+
+def _loadGlobals():
+    ''' Loads a complete new set of globals, leaving the current ones alone. Returns 
+        (allstations,allelements,stationindex,elementindex,datetimebounds,allpors). '''
+    started = time.time()
+    stations = stationDao.getStations()
+    elements = elementDao.getElements()
+    (first,last) = _executeQuery("select min(datetime_id), max(datetime_id) from crn_datetime")[0]
+
+    # Add the artificial subhourly elements to the allelements list
+    esgManager = ElementSubhourlyGroupManager.getManager()
+    for curid in esgManager.getAllIds():
+        elements.put(curid,esgManager.generateElement(curid))
+    loaded = (stations,elements,_StationIndex(stations.values()),_ElementIndex(elements.values()),(int(first),int(last)),
+              _loadPors())
+    _record("freshenGlobals",started,stations.size() + elements.size())
+    return loaded
+
+def _swapGlobals(loaded):
+    ''' Replaces the globals with a set returned by _loadGlobals(). Call with _globalsLock held. '''
     global globalloadtime
+    global globalgeneration
+    global globalsfromsnapshot
     global allstations
     global allelements
+    global allpors
+    global datetimebounds
+    global stationindex
+    global elementindex
+
+    (stations,elements,sindex,eindex,bounds,pors) = loaded
+    # The indexes go in first, so nothing can find a station or element in them that isn't in allstations/allelements
+    stationindex = sindex
+    elementindex = eindex
+    allstations = stations
+    allelements = elements
+    allpors = pors
+    datetimebounds = bounds
+    globalloadtime = time.time()
+    globalgeneration += 1
+    globalsfromsnapshot = False
+
+def _refreshGlobals():
+    ''' Run on a background thread by freshenGlobals(). If reloading fails (eg the database is 
+        unreachable), the current globals are kept and it's tried again a little later. '''
+    global _globalsRefreshing
+    global globalloadtime
+    try:
+        try:
+            loaded = _loadGlobals()
+            _globalsLock.acquire()
+            try:
+                _swapGlobals(loaded)
+            finally:
+                _globalsLock.release()
+            _writeSnapshot(loaded)
+        except:
+            print "Unable to reload stations and elements; will try again shortly.", sys.exc_info()[1]
+            globalloadtime = time.time() - GLOBALSMAXAGE + GLOBALSRETRYDELAY
+    finally:
+        _globalsRefreshing = False
+
+def _confirmGlobals():
+    ''' Called before reporting that no station or element matches. If the globals came from the snapshot
+        and haven't been checked against the database yet, reloads them now (so that something added since
+        the snapshot was saved isn't reported missing) and returns True; otherwise returns False. '''
+    if not globalsfromsnapshot: return False
+    freshenGlobals(wait=True)
+    return True
+
+def _snapshotFilename():
+    return os.path.join(_userDataDirectory(),"metadata.snapshot")
+
+def _readSnapshot():
+    ''' Returns the globals saved by _writeSnapshot(), in the same form as _loadGlobals(), or None if 
+        there's no usable snapshot. PORs go stale too quickly to keep, so they come back as None (and 
+        are loaded when first needed). '''
+    filename = _snapshotFilename()
+    if not os.path.exists(filename): return None
+    started = time.time()
+    try:
+        stream = ObjectInputStream(BufferedInputStream(FileInputStream(filename)))
+        try:
+            if stream.readInt() != METADATASNAPSHOTVERSION: return None
+            stations = stream.readObject()
+            elements = stream.readObject()
+            bounds = (stream.readInt(),stream.readInt())
+        finally:
+            stream.close()
+    except: # A damaged snapshot is no worse than a missing one; it'll be rewritten
+        return None
+    snapshot = (stations,elements,_StationIndex(stations.values()),_ElementIndex(elements.values()),bounds,None)
+    _record("readSnapshot",started,stations.size() + elements.size())
+    return snapshot
+
+def _writeSnapshot(loaded):
+    ''' Saves a set of globals returned by _loadGlobals() for later sessions to start from (Stations and 
+        Elements are Serializable). It's written to a temporary file and then moved into place, so that 
+        another crnscript starting up never reads a half-written snapshot. '''
+    (stations,elements,sindex,eindex,(first,last),pors) = loaded
+    filename = _snapshotFilename()
+    tempname = filename + ".tmp"
+    try:
+        stream = ObjectOutputStream(BufferedOutputStream(FileOutputStream(tempname)))
+        try:
+            stream.writeInt(METADATASNAPSHOTVERSION)
+            stream.writeObject(stations)
+            stream.writeObject(elements)
+            stream.writeInt(first)
+            stream.writeInt(last)
+        finally:
+            stream.close()
+        if os.path.exists(filename): os.remove(filename) # rename won't overwrite on Windows
+        os.rename(tempname,filename)
+    except: # Without a snapshot the next session just starts a little slower
+        print "Unable to save the metadata snapshot:", sys.exc_info()[1]
+
+def _globalsGeneration():
+    ''' Returns the number of times the globals have been (re)loaded. Anything built from allstations 
+        or allelements can remember the generation it was built from and rebuild itself when this 
+        changes. '''
+    return globalgeneration
 
-    if (time.time() - globalloadtime > 1800): # reload every 1/2 hour 
-        #print "Refreshing global variables (allstations,allelements)."
-        globalloadtime = time.time()                                                          
-        allstations = stationDao.getStations() # only load the list of stations once 
-        allelements = elementDao.getElements() # only load the list of elements once
-        
-        # Add the artificial subhourly elements to the allelements list
-        esgManager = ElementSubhourlyGroupManager.getManager()
-        for curid in esgManager.getAllIds():
-            allelements.put(curid,esgManager.generateElement(curid))
-        
 def showElements():
     ''' Prints a list of the special convenient aliases for CRN elements (e.g. "temp" for 
         hourly average temperature). '''
@@ -248,6 +812,34 @@ def _flatten(*in_tuple):
                 flatlist.append(cur)
     return flatlist
 
+def _search(searchStrings,identstring):
+    ''' Takes a list of (object,string,lowercase string) and returns the objects whose strings match 
+        identstring, exactly as re.search() with smartcase would. Strings without special characters are 
+        searched for as plain substrings, which is much faster. '''
+    if not _isLiteral(identstring):
+        pattern = _compiledPattern(identstring)
+        return [o for (o,string,lower) in searchStrings if pattern.search(string)]
+    if identstring == identstring.lower():
+        return [o for (o,string,lower) in searchStrings if identstring in lower]
+    return [o for (o,string,lower) in searchStrings if identstring in string]
+
+_regexcache = _LRUCache(REGEXCACHESIZE)
+def _compiledPattern(identstring):
+    ''' Returns identstring compiled as a regex (with smartcase; see _caseStrategy()), compiling each 
+        pattern only once. '''
+    pattern = _regexcache.get(identstring)
+    if pattern is None:
+        pattern = re.compile(identstring,_caseStrategy(identstring))
+        _regexcache.put(identstring,pattern)
+    return pattern
+
+def _isLiteral(identstring):
+    ''' True if identstring has no regex special characters, so a plain substring search will do. '''
+    for char in identstring:
+        if char in ".^$*+?{}[]\\|()":
+            return False
+    return True
+
 def _caseStrategy(identstring):
     ''' Returns the case-handling strategy appropriate for a particular string
         (case insensitive if all lower-case, otherwise case sensitive). The
@@ -265,6 +857,71 @@ def __doctests():
     >>> findStation("Barrow")
     Station[1007] AK Barrow 4 ENE (00F0B0,27516)Comm:E, OpStat: Y
         
+    Station lookups go through an index, but give exactly the same answers as searching every station:
+    >>> bruteForce = lambda q: sorted([s for s in allstations.values() if re.search(q,str(s),_caseStrategy(q))])
+    >>> queries = ["barrow","Barrow","AK Barrow","AK Barrow 4 ENE","27516","stillwater 5","OK Stillwater 2 W","^Station\\[10","W \\(","Comm:E"]
+    >>> [sorted(findStations(q)) == bruteForce(q) for q in queries]
+    [True, True, True, True, True, True, True, True, True, True]
+    >>> findStations(1007) == findStations("1007")
+    True
+
+    The same goes for elements:
+    >>> bruteForce = lambda q: sorted([e for e in allelements.values() if re.search(q,str(e),_caseStrategy(q))])
+    >>> queries = ["T_OFFICIAL","T_OFFICIAL","official","T5_6","soil moisture","^Element 3:","P_"]
+    >>> [sorted(findElements(q)) == bruteForce(q) for q in queries]
+    [True, True, True, True, True, True, True]
+    >>> findElements("temp") == findElements("T_OFFICIAL")
+    True
+
+    Reloading the globals swaps in a new generation; lookups carry on as before:
+    >>> generation = _globalsGeneration()
+    >>> freshenGlobals(wait=True)
+    >>> _globalsGeneration() == generation + 1
+    True
+    >>> findStation("Barrow")
+    Station[1007] AK Barrow 4 ENE (00F0B0,27516)Comm:E, OpStat: Y
+
+    Lists of ranges are sorted, and overlapping or adjacent ranges merged:
+    >>> _parseDatetimeRanges([(87791,87792),(87794,87794),(87792,87793),(87800,"+2")])
+    [(87791, 87794), (87800, 87802)]
+    >>> _parseDatetimeRanges(("2009010100","+2")) == [_parseDatetimeParam(("2009010100","+2"))]
+    True
+    >>> _parseDatetimeParam([(87791,87792),(87800,87802)])
+    Traceback (most recent call last):
+    ...
+    ValueError: Expected a single datetime or range here, not a list of ranges
+
+    A DateRange with a step stands for every nth hour, so getData() and friends get just those hours:
+    >>> _parseDatetimeRanges(dateRange("2009010100","2009010200",12))
+    [(72255, 72255), (72267, 72267)]
+    >>> _parseDatetimeRanges([dateRange("2009010100","2009010200",12),(72256,72256)])
+    [(72255, 72256), (72267, 72267)]
+    >>> sorted([f.datetimeId for f in getData("barrow",dateRange("2009010100","2009010200",12),"temp")])
+    [72255, 72267]
+
+    Local days and months are worked out with integer arithmetic, and agree with the datetime table:
+    >>> d = getData("stillwater 5",("10/10/10 1:00","+35"),"temp").factlist
+    >>> days = _localDayStrings(d)
+    >>> [days.count(day) for day in sorted(set(days))]
+    [6, 24, 6]
+    >>> days == [findDate(f.datetimeId + f.station.getOffset() - 1).datetime0_23[0:8] for f in d]
+    True
+    >>> days == [_localDayString(f.stationId,f.datetimeId) for f in d]
+    True
+    >>> sorted(set([_monthString(m) for m in _localMonthOrdinals(d)]))
+    ['201010']
+    >>> _dayString(_daysFromCivil(2008,2,29)), _monthString(_localMonthOrdinal(1007,72255)), _monthString(2010*12+11)
+    ('20080229', '200812', '201012')
+
+    Each load is saved as a snapshot for the next session to start from:
+    >>> (stations,elements,sindex,eindex,bounds,pors) = _readSnapshot()
+    >>> sorted(stations.keySet()) == sorted(allstations.keySet()), bounds == datetimebounds
+    (True, True)
+    >>> [str(elements[e]) == str(allelements[e]) for e in allelements.keySet()].count(False)
+    0
+    >>> sindex.find("barrow") == stationindex.find("barrow")
+    True
+
     findElement() and findElements() parallel findStations() closely.
     >>> e = findElements(["official","17"],(findElement(3),"T5_6"))
     >>> printlist(e)
@@ -286,6 +943,14 @@ def __doctests():
     >>> type(por)
     <type 'gov.noaa.ncdc.crn.domain.POR'>
 
+    PORs for every station are loaded at once and answered from memory, as is "now":
+    >>> getPor("barrow") is por, _cachedPors([1007])[1007] is por
+    (True, True)
+    >>> (por.getStartDatetime(),por.getEndDatetime()) == (porDao.getPor(1007).getStartDatetime(),porDao.getPor(1007).getEndDatetime())
+    True
+    >>> findDate("now").datetimeId == _porRegistry()[NOWSTATIONID].getEndDatetime()
+    True
+
     >>> from datetime import timedelta, tzinfo
     >>> from datetime import datetime as python_datetime
     >>> class Eastern(tzinfo):
@@ -307,6 +972,49 @@ def __doctests():
     >>> print findDate(dt)
     Datetime 87793:2010101010 UTC
 
+    Datetimes are worked out locally from the datetime id, without going to the database:
+    >>> _stringFromDatetimeId(72255)
+    '2009010100'
+    >>> _datetimeIdFromString("2010101010")
+    87793
+    >>> [_datetimeIdFromString(s) for s in ("2009022900","2008022900","2009010124","200901","20090101","200")]
+    [None, 64887, None, 72255, 72255, None]
+    >>> findDate("20090101").getDatetimeId()
+    72255
+    >>> _localStandardString(72255,-9)
+    '2008123115'
+    >>> _datetimeIdFromPython(_pythonDatetimeFromId(81785))
+    81785
+    >>> [_civilFromDays(_daysFromCivil(y,m,d)) == (y,m,d) for (y,m,d) in [(1999,12,31),(2000,2,29),(2100,3,1)]]
+    [True, True, True]
+    >>> findDate(80000) == datetimeDao.getDatetime(80000)
+    True
+
+    dateRange() works like xrange, but over hours:
+    >>> r = dateRange("2009010100","2009010200")
+    >>> len(r)
+    24
+    >>> (r[0],r[-1])
+    (Datetime 72255:2009010100 UTC, Datetime 72278:2009010123 UTC)
+    >>> (findDate("2009010112") in r, findDate("2009010200") in r, 72256 in r[::2], 72257 in r[::2])
+    (True, False, True, False)
+    >>> [d.datetimeId for d in reversed(r[0:3])]
+    [72257, 72256, 72255]
+    >>> (len(dateRange("2009010100","2009010200",5)), len(r[::2]), r[::2][1].datetimeId, len(r[30:]))
+    (5, 12, 72257, 0)
+    >>> _parseDatetimeParam(r)
+    (72255, 72278)
+    >>> _parseDatetimeParam(dateRange("2009010100","2009010200",12))
+    Traceback (most recent call last):
+    ...
+    ValueError: A DateRange with a step of 12 hours isn't a single range
+
+    Datetimes are shared, so the same hour is always the same object:
+    >>> findDate(80000) is findDate("2009111917")
+    True
+    >>> _subhourlyDatetime(79999,"200911191635") is _subhourlyDatetime(79999,"200911191635")
+    True
+
 '''
     
 if __name__ == "__main__":
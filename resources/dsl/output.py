@@ -38,7 +38,7 @@ def printlist(*data,**kwargs):
         data = zip(data.keys(), data.values())
         
     try:
-        if sortData: data = sorted(data) 
+        if sortData: data = _sorted(data)
         for n in data:
             print str(n).rstrip('\r\n')
     except: # In case the user accidentally passes in something un-iterable
@@ -66,7 +66,7 @@ def printfile(filename,data,sortData=True,append=False):
         data = zip(data.keys(), data.values())
     
     try:
-        if sortData: data = sorted(data)
+        if sortData: data = _sorted(data)
         for n in data:
             file.write(str(n).rstrip('\r\n'))
             file.write("\n")
@@ -75,6 +75,13 @@ def printfile(filename,data,sortData=True,append=False):
 
     file.close()
 
+def _sorted(data):
+    ''' Returns data sorted; a FactCollection sorts its own Facts, which for a columnar one (see getData()) 
+        avoids creating them all at once. '''
+    if isinstance(data,FactCollection):
+        return data._sortedFacts()
+    return sorted(data)
+
 def csv(*data):
     ''' Takes the output from getData and formats it in csv, suitable for 
         pasting into Excel, sorted by station, date, element. Alternately, it accepts the same 
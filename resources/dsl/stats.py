@@ -0,0 +1,141 @@
+'''
+Instrumentation for finding out where a slow script spends its time. getData(), getPor() and the loading
+of station and element metadata record, for each phase of their work (the database query, converting rows
+to Facts, grouping, sorting, and so on), how many times it ran, how long it took, how many rows it handled
+and roughly how much memory those rows take up. Lookups which scripts make per fact or per loop (findDate(),
+findStations() and findElements()) are only counted, not timed, so that they stay cheap. Call queryStats() at
+the console to see a ranked breakdown, dumpQueryStats() to write the same numbers to a file (eg at the end of
+a batch job), and resetQueryStats() to start counting over.
+
+Phases can include one another (eg getData includes dao and conversion), so the times don't add up to
+the total; the point is to see which phase dominates.
+'''
+
+import threading, time
+import functools
+from java.util.concurrent.atomic import AtomicLong
+
+# Rough sizes (in bytes) of the objects each phase produces, for estimating memory use
+ELEMENTVALUEBYTES = 200
+FACTBYTES = 450
+
+_stats = {} # phase -> [calls, seconds, rows, bytes]
+_statsLock = threading.Lock()
+_lookupCalls = {} # phase -> AtomicLong, for the lookups which are only counted (see _counted())
+
+def queryStats():
+    ''' Prints a breakdown of where time has gone in getData() and the other recorded phases since the session
+        started (or since resetQueryStats()), slowest phase first. '''
+    rows = _statsRows()
+    if not rows:
+        print "No queries recorded yet."
+        return
+    print "%-16s %8s %10s %10s %12s %10s" % ("phase","calls","seconds","ms/call","rows","est. MB")
+    for (phase,calls,seconds,numRows,numBytes) in rows:
+        if phase in _lookupCalls:
+            print "%-16s %8d %10s %10s %12s %10s" % (phase, calls, "-", "-", "-", "-")
+        else:
+            print "%-16s %8d %10.2f %10.2f %12d %10.1f" % (phase, calls, seconds, 1000.0 * seconds / calls,
+                                                            numRows, numBytes / 1048576.0)
+
+def dumpQueryStats(filename):
+    ''' Writes the numbers shown by queryStats() to the given file, as comma-separated values (phase, calls,
+        seconds, rows, estimated bytes), slowest phase first. Lookups, which are only counted, have 0 seconds,
+        rows and bytes. '''
+    outfile = open(filename,"w")
+    try:
+        outfile.write("phase,calls,seconds,rows,bytes\n")
+        for (phase,calls,seconds,numRows,numBytes) in _statsRows():
+            outfile.write("%s,%d,%.3f,%d,%d\n" % (phase,calls,seconds,numRows,numBytes))
+    finally:
+        outfile.close()
+
+def resetQueryStats():
+    ''' Forgets everything recorded so far. '''
+    _statsLock.acquire()
+    try:
+        _stats.clear()
+    finally:
+        _statsLock.release()
+    for calls in _lookupCalls.values():
+        calls.set(0)
+
+def _record(phase,started,rows=0,numBytes=0):
+    ''' Records one run of the given phase, which began at time started (from time.time()). Safe to call
+        from several threads at once (as getDataParallel() does). '''
+    elapsed = time.time() - started
+    _statsLock.acquire()
+    try:
+        entry = _stats.setdefault(phase,[0,0.0,0,0])
+        entry[0] += 1
+        entry[1] += elapsed
+        entry[2] += rows
+        entry[3] += numBytes
+    finally:
+        _statsLock.release()
+
+def _instrumented(phase,bytesPerRow=0):
+    ''' Decorator which records each call of the decorated function under the given phase. If the result
+        has a length, it's counted as the number of rows. '''
+    def decorate(function):
+        def instrumented(*args,**kwargs):
+            started = time.time()
+            result = function(*args,**kwargs)
+            try:
+                rows = len(result)
+            except (TypeError,AttributeError):
+                rows = 1
+            _record(phase,started,rows,rows * bytesPerRow)
+            return result
+        return functools.wraps(function)(instrumented)
+    return decorate
+
+def _counted(phase):
+    ''' Decorator for lookups which scripts call per fact or per loop (eg findDate()): counts each call under
+        the given phase, without timing it or taking _statsLock, which would cost more than most lookups do. '''
+    calls = _lookupCalls.setdefault(phase,AtomicLong())
+    def decorate(function):
+        def counted(*args,**kwargs):
+            calls.incrementAndGet()
+            return function(*args,**kwargs)
+        return functools.wraps(function)(counted)
+    return decorate
+
+def _statsRows():
+    ''' Returns a list of (phase,calls,seconds,rows,bytes), slowest phase first. '''
+    _statsLock.acquire()
+    try:
+        rows = [(phase,calls,seconds,numRows,numBytes) for (phase,(calls,seconds,numRows,numBytes)) in _stats.items()]
+    finally:
+        _statsLock.release()
+    rows.extend([(phase,calls.get(),0.0,0,0) for (phase,calls) in _lookupCalls.items() if calls.get()])
+    rows.sort(key=lambda row: -row[2])
+    return rows
+
+def __doctests():
+    ''' These doctests are automatically run if you run the module. You should get no output
+        unless there's a problem.
+
+    >>> resetQueryStats()
+    >>> @_instrumented("example",bytesPerRow=10)
+    ... def example(n): return range(n)
+    >>> example(3) + example(4)
+    [0, 1, 2, 0, 1, 2, 3]
+    >>> [(phase,calls,numRows,numBytes) for (phase,calls,seconds,numRows,numBytes) in _statsRows()]
+    [('example', 2, 7, 70)]
+    >>> example.__name__
+    'example'
+    >>> @_counted("lookup")
+    ... def lookup(x): return x * 2
+    >>> [lookup(x) for x in range(3)]
+    [0, 2, 4]
+    >>> [(phase,calls) for (phase,calls,seconds,numRows,numBytes) in _statsRows()]
+    [('example', 2), ('lookup', 3)]
+    >>> resetQueryStats()
+    >>> queryStats()
+    No queries recorded yet.
+    '''
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -8,7 +8,7 @@ Created on Jan 19, 2011
 
 from crn import *
 
-import os, re, time
+import os, re, time, threading
 from ftplib import FTP
 
 #from Fact import Fact
@@ -103,4 +103,70 @@ def _createEmptyDirectory(path):
     else:
         os.makedirs(path)
 
+class _LRUCache(object):
+    ''' A small least-recently-used cache: like a dict, but once it holds more than maxSize entries, it drops 
+        the half that were used longest ago. Safe to share between threads. '''
+    def __init__(self,maxSize):
+        self.maxSize = maxSize
+        self._entries = {} # key -> [value, time of last use]
+        self._clock = 0
+        self._lock = threading.Lock()
+
+    def get(self,key,default=None):
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            self._clock += 1
+            entry[1] = self._clock
+            return entry[0]
+        finally:
+            self._lock.release()
+
+    def put(self,key,value):
+        self._lock.acquire()
+        try:
+            self._clock += 1
+            self._entries[key] = [value,self._clock]
+            if len(self._entries) > self.maxSize:
+                lastUses = sorted([entry[1] for entry in self._entries.values()])
+                cutoff = lastUses[len(lastUses) / 2]
+                for (k,entry) in self._entries.items():
+                    if entry[1] < cutoff:
+                        del self._entries[k]
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._entries.clear()
+        finally:
+            self._lock.release()
+
+    def __len__(self):
+        return len(self._entries)
+
+def _executeQuery(query,params=[]):
+    ''' Runs a select statement with the given (integer) parameters against the connection pool and returns
+        the results as a list of rows, each a list of strings (or None for nulls). For the few queries which
+        crnshared's DAOs don't provide. '''
+    connection = dataSource.getConnection()
+    try:
+        statement = connection.prepareStatement(query)
+        try:
+            for (i,param) in enumerate(params):
+                statement.setInt(i+1,param) # 1-indexed
+            resultset = statement.executeQuery()
+            numColumns = resultset.getMetaData().getColumnCount()
+            rows = []
+            while resultset.next():
+                rows.append([resultset.getString(i+1) for i in range(numColumns)])
+            return rows
+        finally:
+            statement.close()
+    finally:
+        connection.close() # returns it to the pool
+
 ''' Note -- no doctests; none of these functions is really testable. '''
@@ -16,18 +16,25 @@ month = 10
 stations = [s for s in getAllStations() if s.networkId == 3]
 elements = findElements('temp','precip')
 
+monthStart = findDate('%d%02d0201' %(year,month)).datetimeId
+monthEnd   = findDate('%d%02d0300' %(year,month+1)).datetimeId
+
+# Count in the database rather than pulling every fact; counts are keyed by (stationId,elementId)
+counts = {}
+for c in getCounts(stations,(monthStart,monthEnd),elements):
+    counts[(c.stationId,c.elementId)] = c.count + c.missing
+temp,precip = findElement('temp'),findElement('precip')
+
 print "Station,Possible hours,% Temp,% Precip"
 
 for station in sorted(stations):
-    start = max(findDate('%d%02d0201' %(year,month)).datetimeId , getPor(station).startDatetime)
-    end   = findDate('%d%02d0300' %(year,month+1)).datetimeId
+    start = max(monthStart, getPor(station).startDatetime)
+    end   = monthEnd
     if end < start: continue
     possibleHours = (end - start) + 1
 
-    d = getData(station,(start,end),elements)
-
-    numTemp   = len(d.forElement('temp'))
-    numPrecip = len(d.forElement('precip'))
+    numTemp   = counts.get((station.stationId,temp.elementId),0)
+    numPrecip = counts.get((station.stationId,precip.elementId),0)
        
     availableTemp   = 100.0 * numTemp   / possibleHours
     availablePrecip = 100.0 * numPrecip / possibleHours
@@ -0,0 +1,73 @@
+'''
+Measures how much memory a Fact takes, by creating a million of them and comparing the JVM's
+heap use before and after. Compares three layouts, so that each change can be seen on its own:
+the old Fact, in which every Fact had its own attribute dict, a Decimal value and a reference to
+the ElementSubhourlyGroupManager (emulated here by DictFact); a Fact with __slots__ but still
+a Decimal value (emulated by DecimalSlotFact); and the current Fact, which has __slots__ and
+keeps its value as a scaled integer, only making the Decimal when value is read. No database
+queries are made. Needs a heap of a gigabyte or so; if you run out of memory, lower NUMFACTS
+or raise -Xmx. The figures include each Fact's slot in the list holding the Facts, and (for
+the first two layouts) its Decimal value; none of the current Facts' values are read.
+'''
+
+from crn import *
+from ElementSubhourlyGroupManager import ElementSubhourlyGroupManager
+import gov.noaa.ncdc.crn.domain.ElementValue as ElementValue
+from java.lang import Runtime, System
+import time
+
+NUMFACTS = 1000000
+
+class DictFact(object):
+    ''' The fields of a Fact, laid out the way they were before __slots__. (Subclassing Fact
+        wouldn't do, since its fields would still go in the slots.) '''
+    def __init__(self,elementValue):
+        self.stationId      = int(elementValue.stationId)
+        self.datetimeId     = int(elementValue.datetimeId)
+        self.elementId      = int(elementValue.elementId)
+        self.value          = Decimal(elementValue.getValue())
+        self.flag           = int(elementValue.getFlags().intValue())
+        self.decimalPlaces  = int(elementValue.getDecimalPlaces() or 0)
+        self.publishedDecimalPlaces = int(elementValue.getPublishedDecimalPlaces() or 0)
+        self._esgManager     = ElementSubhourlyGroupManager.getManager()
+
+class DecimalSlotFact(object):
+    ''' The fields of a Fact with __slots__, but with the value kept as a Decimal, as it was before
+        Facts kept scaled integers. '''
+    __slots__ = ("stationId","datetimeId","elementId","value","flag","decimalPlaces","publishedDecimalPlaces",
+                 "_station","_element","_datetime",
+                 "_subhourlyName","_subhourlyId","_subhourlyDescription","_subhourlyTime")
+    def __init__(self,elementValue):
+        self.stationId      = int(elementValue.stationId)
+        self.datetimeId     = int(elementValue.datetimeId)
+        self.elementId      = int(elementValue.elementId)
+        self.value          = Decimal(elementValue.getValue())
+        self.flag           = int(elementValue.getFlags().intValue())
+        self.decimalPlaces  = int(elementValue.getDecimalPlaces() or 0)
+        self.publishedDecimalPlaces = int(elementValue.getPublishedDecimalPlaces() or 0)
+
+def usedMemory():
+    for i in range(3): # gc() is only a hint, so insist
+        System.gc()
+        time.sleep(0.1)
+    runtime = Runtime.getRuntime()
+    return runtime.totalMemory() - runtime.freeMemory()
+
+def bytesPerFact(factClass,numFacts=NUMFACTS):
+    ''' Returns the average heap used by each of numFacts Facts of factClass. '''
+    elementValues = [ElementValue(1007,72255+i,343,str(i % 400 / 10.0),0,1,1) for i in range(8760)]
+    before = usedMemory()
+    facts = [factClass(elementValues[i % 8760]) for i in xrange(numFacts)]
+    after = usedMemory()
+    assert len(facts) == numFacts # keeps facts alive until after the measurement
+    return (after - before) / float(numFacts)
+
+dictBytes    = bytesPerFact(DictFact)
+decimalBytes = bytesPerFact(DecimalSlotFact)
+slotBytes    = bytesPerFact(Fact)
+print "%d Facts" % NUMFACTS
+print "  with a dict per Fact:            %6.1f bytes per Fact" % dictBytes
+print "  with __slots__ and a Decimal:    %6.1f bytes per Fact" % decimalBytes
+print "  with __slots__ and a scaled int: %6.1f bytes per Fact" % slotBytes
+print "  __slots__ saves:                 %6.1f bytes per Fact (%.0f MB per million)" % (dictBytes - decimalBytes, (dictBytes - decimalBytes) * 1000000 / 1048576)
+print "  the scaled int saves:            %6.1f bytes per Fact (%.0f MB per million)" % (decimalBytes - slotBytes, (decimalBytes - slotBytes) * 1000000 / 1048576)
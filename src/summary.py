@@ -4,6 +4,7 @@ Created on Jun 22, 2011
 @author: scott.embler
 '''
 from period import *
+from dsl.domainquery import _localDate
 from decimal import Decimal, ROUND_HALF_UP
 
 def byLocalDay(fact):
@@ -12,13 +13,10 @@ def byLocalDay(fact):
     a key for grouping/sorting/filtering collections.  The Day returned is always
     in the local-time of the station which produced the Fact.
     '''
-    #To get the date in local time, we offset by the time difference, and then offset
-    #by -1 because crn datetimes refers to the *end* of the observation hour, whereas
-    #python datetimes use the beginning of the hour.
-    localdate = fact.getDatetime().add(fact.station.getOffset()).add(-1)
-    #Keep in mind that the Datetime objects use Java calendars, which uses a 0-11
-    #indexing instead of the 1-12 indexing that python expects. Add 1 to fix this.
-    return Day(localdate.getYear(), localdate.getMonth() + 1, localdate.getDay(), tzinfo=StationTz(fact.getStation()))
+    #_localDate offsets by the time difference, and then by -1 because crn datetimes refer
+    #to the *end* of the observation hour, whereas python datetimes use the beginning of the hour.
+    (year, month, day) = _localDate(fact.stationId, fact.datetimeId)
+    return Day(year, month, day, tzinfo=StationTz(fact.getStation()))
 
 def byLocalMonth(fact):
     '''
@@ -26,13 +24,9 @@ def byLocalMonth(fact):
     a key for grouping/sorting/filtering collections.  The Month returned is always
     in the local-time of the station which produced the Fact.
     '''
-    #To get the date in local time, we offset by the time difference, and then offset
-    #by -1 because crn datetimes refers to the *end* of the observation hour, whereas
-    #python datetimes use the beginning of the hour.
-    localdate = fact.getDatetime().add(fact.station.getOffset()).add(-1)
-    #Keep in mind that the Datetime objects use Java calendars, which uses a 0-11
-    #indexing instead of the 1-12 indexing that python expects. Add 1 to fix this.
-    return Month(localdate.getYear(), localdate.getMonth() + 1, tzinfo=StationTz(fact.getStation()))
+    #See byLocalDay.
+    (year, month, day) = _localDate(fact.stationId, fact.datetimeId)
+    return Month(year, month, tzinfo=StationTz(fact.getStation()))
 
 
 class SOD: